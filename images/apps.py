@@ -1,13 +1,37 @@
 from django.apps import AppConfig
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from images.utils import get_b2_resource
 
+from images.cache import invalidate_variant_cache
+from images.deletions import schedule_s3_deletion
 
-@receiver(post_delete)
-def delete_image_from_s3_if_variant_is_deleted(sender, instance, **kwargs):
-    bucket = get_b2_resource()
-    bucket.delete_objects(Delete={"Objects": [{"Key": instance.s3_filepath}]})
+
+@receiver(post_delete, sender="images.ImageVariant")
+def delete_image_from_s3_if_variant_is_deleted(sender, instance, using, **kwargs):
+    invalidate_variant_cache(
+        instance.image_id,
+        instance.width,
+        instance.height,
+        instance.gaussian_blur,
+        instance.brightness,
+    )
+
+    schedule_s3_deletion(instance.s3_filepath, using)
+
+
+@receiver(post_delete, sender="images.Image")
+def invalidate_image_record_cache(sender, instance, **kwargs):
+    from images.metadata import invalidate_image_record
+
+    invalidate_image_record(instance.id)
+
+
+@receiver(post_save, sender="images.AuthorizationKey")
+@receiver(post_delete, sender="images.AuthorizationKey")
+def invalidate_authorization_key_cache(sender, instance, **kwargs):
+    from images.authorization import invalidate_authorization_key
+
+    invalidate_authorization_key(instance.id)
 
 
 class ImagesConfig(AppConfig):
@@ -0,0 +1,65 @@
+import uuid
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.db import transaction
+
+from images.cache import bump_authorization_keys_version, get_authorization_keys_version
+from images.models import AuthorizationKey
+from images.utils import LRUCache
+
+
+class KeyPermissions(NamedTuple):
+    can_upload_image: bool
+    can_upload_variant: bool
+
+
+# Unknown keys are cached as None, so that requests with an invalid key don't reach the database either. Entries are
+# stored with the version of the keys in Valkey when they were read, and any change to a key bumps that version, so
+# the other processes drop their entries on their next lookup.
+authorization_key_cache = LRUCache(max_size=settings.AUTHORIZATION_KEY_CACHE_SIZE)
+
+
+def parse_key(header_value: str) -> Optional[uuid.UUID]:
+    try:
+        return uuid.UUID(header_value)
+    except ValueError:
+        return None
+
+
+def get_key_permissions(header_value: str) -> Optional[KeyPermissions]:
+    key_id = parse_key(header_value)
+    if key_id is None:
+        return None
+
+    version = get_authorization_keys_version()
+
+    found, entry = authorization_key_cache.get(key_id)
+    if found and entry[0] == version:
+        return entry[1]
+
+    key = (
+        AuthorizationKey.objects.filter(id=key_id)
+        .values_list("can_upload_image", "can_upload_variant")
+        .first()
+    )
+    permissions = KeyPermissions(*key) if key is not None else None
+
+    authorization_key_cache.set(
+        key_id,
+        (version, permissions),
+        ttl=(
+            settings.AUTHORIZATION_KEY_CACHE_TTL
+            if permissions is not None
+            else settings.AUTHORIZATION_KEY_NEGATIVE_CACHE_TTL
+        ),
+    )
+
+    return permissions
+
+
+def invalidate_authorization_key(key_id: uuid.UUID):
+    authorization_key_cache.invalidate(key_id)
+    # Another process could otherwise read the key again before the change is committed, and cache it with the new
+    # version
+    transaction.on_commit(bump_authorization_keys_version)
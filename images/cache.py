@@ -0,0 +1,286 @@
+import logging
+from uuid import UUID
+
+import valkey
+from django.conf import settings
+
+from images.utils import get_valkey_client
+
+logger = logging.getLogger(__name__)
+
+VARIANT_CACHE_LOOKUPS_KEY = "kakigoori:variant_cache:lookups"
+VARIANT_CACHE_MISSES_KEY = "kakigoori:variant_cache:misses"
+
+# The variant cache of a size is a hash of the URLs for each list of formats, with a generation field bumped by each
+# invalidation. URLs are only written if the generation hasn't changed since the lookup that missed, so a view can't
+# cache what it read from the database just before a worker made a better variant available.
+VARIANT_CACHE_GENERATION_FIELD = "generation"
+
+SET_VARIANT_URL_SCRIPT = """
+if (redis.call('HGET', KEYS[1], ARGV[1]) or '') ~= ARGV[2] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[3], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return 1
+"""
+
+INVALIDATE_VARIANT_SCRIPT = """
+local generation = redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], ARGV[1], generation)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+"""
+AUTHORIZATION_KEYS_VERSION_KEY = "kakigoori:authorization_keys:version"
+
+
+def negotiated_formats(image_type: str, accept_header: str) -> list[str]:
+    if image_type == "auto":
+        formats = []
+        if "image/avif" in accept_header:
+            formats.append("avif")
+        if "image/webp" in accept_header:
+            formats.append("webp")
+        return formats + ["jpg", "png"]
+    elif image_type == "original":
+        return ["jpg", "png"]
+    else:
+        return [image_type]
+
+
+def variant_cache_key(
+    image_id: UUID, width: int, height: int, gaussian_blur: float, brightness: float
+) -> str:
+    return f"kakigoori:variant:{image_id.hex}:{width}:{height}:{float(gaussian_blur)}:{float(brightness)}"
+
+
+def get_cached_variant_url(
+    image_id: UUID,
+    width: int,
+    height: int,
+    gaussian_blur: float,
+    brightness: float,
+    formats: list[str],
+) -> tuple[str | None, str | None]:
+    # Returns the URL, and the generation of the cache to give to set_cached_variant_url on misses. The generation
+    # is None when the URL can't be cached.
+    client = get_valkey_client()
+    if client is None:
+        return None, None
+
+    key = variant_cache_key(image_id, width, height, gaussian_blur, brightness)
+
+    try:
+        # Hits are derived from lookups - misses, so a hit only costs one round trip
+        pipeline = client.pipeline(transaction=False)
+        pipeline.hmget(key, [",".join(formats), VARIANT_CACHE_GENERATION_FIELD])
+        pipeline.incr(VARIANT_CACHE_LOOKUPS_KEY)
+        (url, generation), _ = pipeline.execute()
+
+        if url is None:
+            client.incr(VARIANT_CACHE_MISSES_KEY)
+            return None, (generation or b"").decode("utf-8")
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to read the variant cache")
+        return None, None
+
+    return url.decode("utf-8"), None
+
+
+def set_cached_variant_url(
+    image_id: UUID,
+    width: int,
+    height: int,
+    gaussian_blur: float,
+    brightness: float,
+    formats: list[str],
+    url: str,
+    generation: str | None,
+):
+    client = get_valkey_client()
+    if client is None or generation is None:
+        return
+
+    key = variant_cache_key(image_id, width, height, gaussian_blur, brightness)
+
+    try:
+        client.register_script(SET_VARIANT_URL_SCRIPT)(
+            keys=[key],
+            args=[
+                VARIANT_CACHE_GENERATION_FIELD,
+                generation,
+                ",".join(formats),
+                url,
+                settings.VARIANT_CACHE_TTL,
+            ],
+        )
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to write the variant cache")
+
+
+def invalidate_variant_cache(
+    image_id: UUID, width: int, height: int, gaussian_blur: float, brightness: float
+):
+    client = get_valkey_client()
+    if client is None:
+        return
+
+    try:
+        client.register_script(INVALIDATE_VARIANT_SCRIPT)(
+            keys=[
+                variant_cache_key(image_id, width, height, gaussian_blur, brightness)
+            ],
+            args=[VARIANT_CACHE_GENERATION_FIELD, settings.VARIANT_CACHE_TTL],
+        )
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to invalidate the variant cache")
+
+
+def image_cache_key(image_id: UUID) -> str:
+    return f"kakigoori:image:{image_id.hex}"
+
+
+def get_cached_image_size(image_id: UUID) -> tuple[int, int] | None:
+    client = get_valkey_client()
+    if client is None:
+        return None
+
+    try:
+        value = client.get(image_cache_key(image_id))
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to read the image cache")
+        return None
+
+    if value is None:
+        return None
+
+    width, height = value.split(b":")
+    return int(width), int(height)
+
+
+def set_cached_image_size(image_id: UUID, width: int, height: int):
+    client = get_valkey_client()
+    if client is None:
+        return
+
+    try:
+        client.set(
+            image_cache_key(image_id),
+            f"{width}:{height}",
+            ex=settings.IMAGE_CACHE_TTL,
+        )
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to write the image cache")
+
+
+def invalidate_image_cache(image_id: UUID):
+    client = get_valkey_client()
+    if client is None:
+        return
+
+    try:
+        client.delete(image_cache_key(image_id))
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to invalidate the image cache")
+
+
+def get_authorization_keys_version() -> int | None:
+    client = get_valkey_client()
+    if client is None:
+        return None
+
+    try:
+        return int(client.get(AUTHORIZATION_KEYS_VERSION_KEY) or 0)
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to read the authorization keys version")
+        return None
+
+
+def bump_authorization_keys_version():
+    client = get_valkey_client()
+    if client is None:
+        return
+
+    try:
+        client.incr(AUTHORIZATION_KEYS_VERSION_KEY)
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to bump the authorization keys version")
+
+
+def mark_resize_pending(
+    image_id: UUID, width: int, height: int, gaussian_blur: float, brightness: float
+) -> bool:
+    client = get_valkey_client()
+    if client is None:
+        return True
+
+    key = variant_cache_key(image_id, width, height, gaussian_blur, brightness)
+
+    try:
+        return bool(
+            client.set(
+                f"{key}:resize_pending", 1, nx=True, ex=settings.RESIZE_PENDING_TTL
+            )
+        )
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to mark the resize as pending")
+        return True
+
+
+def clear_resize_pending(
+    image_id: UUID, width: int, height: int, gaussian_blur: float, brightness: float
+):
+    client = get_valkey_client()
+    if client is None:
+        return
+
+    key = variant_cache_key(image_id, width, height, gaussian_blur, brightness)
+
+    try:
+        client.delete(f"{key}:resize_pending")
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to clear the pending resize")
+
+
+def increment_counters(counters: dict[str, int]):
+    client = get_valkey_client()
+    if client is None:
+        return
+
+    try:
+        pipeline = client.pipeline(transaction=False)
+        for key, amount in counters.items():
+            pipeline.incrby(key, amount)
+        pipeline.execute()
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to update the cache counters")
+
+
+def get_counters(*keys: str) -> list[int] | None:
+    client = get_valkey_client()
+    if client is None:
+        return None
+
+    try:
+        values = client.mget(*keys)
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to read the cache counters")
+        return None
+
+    return [int(value or 0) for value in values]
+
+
+def get_variant_cache_stats() -> dict[str, int | float] | None:
+    counters = get_counters(VARIANT_CACHE_LOOKUPS_KEY, VARIANT_CACHE_MISSES_KEY)
+    if counters is None:
+        return None
+
+    lookups, misses = counters
+    hits = lookups - misses
+
+    return {
+        "lookups": lookups,
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / lookups if lookups else 0.0,
+    }
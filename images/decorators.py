@@ -1,9 +1,14 @@
 from functools import wraps
-from typing import Optional
 
 from django.http import JsonResponse, HttpResponseForbidden
 
-from images.models import Image, AuthorizationKey
+from images.authorization import get_key_permissions
+from images.metadata import (
+    get_image_record,
+    get_image_record_async,
+    invalidate_local_image_record,
+)
+from images.models import Image
 
 
 def get_image(func):
@@ -11,26 +16,52 @@ def get_image(func):
     def wrapper(request, *args, **kwargs):
         image_id = kwargs["image_id"]
         del kwargs["image_id"]
-        image = Image.objects.filter(id=image_id).first()
+        image = get_image_record(image_id)
         if image is None:
             return JsonResponse({"error": "Image not found"}, status=404)
 
-        return func(request=request, image=image, *args, **kwargs)
+        try:
+            return func(request=request, image=image, *args, **kwargs)
+        except Image.DoesNotExist:
+            # The record was cached by this process before the image was deleted by another one
+            invalidate_local_image_record(image_id)
+            return JsonResponse({"error": "Image not found"}, status=404)
 
     return wrapper
 
 
-def can_upload_image(func):
+def get_image_async(func):
     @wraps(func)
-    def wrapper(request, *args, **kwargs):
-        if "Authorization" not in request.headers:
-            return HttpResponseForbidden()
+    async def wrapper(request, *args, **kwargs):
+        image_id = kwargs["image_id"]
+        del kwargs["image_id"]
+        image = await get_image_record_async(image_id)
+        if image is None:
+            return JsonResponse({"error": "Image not found"}, status=404)
+
+        try:
+            return await func(request=request, image=image, *args, **kwargs)
+        except Image.DoesNotExist:
+            # The record was cached by this process before the image was deleted by another one
+            invalidate_local_image_record(image_id)
+            return JsonResponse({"error": "Image not found"}, status=404)
+
+    return wrapper
+
+
+def has_permission(request, permission):
+    if "Authorization" not in request.headers:
+        return False
 
-        authorization_key: Optional[AuthorizationKey] = AuthorizationKey.objects.filter(
-            id=request.headers["Authorization"], can_upload_image=True
-        ).first()
+    permissions = get_key_permissions(request.headers["Authorization"])
 
-        if not authorization_key:
+    return permissions is not None and getattr(permissions, permission)
+
+
+def can_upload_image(func):
+    @wraps(func)
+    def wrapper(request, *args, **kwargs):
+        if not has_permission(request, "can_upload_image"):
             return HttpResponseForbidden()
 
         return func(request, *args, **kwargs)
@@ -41,14 +72,7 @@ def can_upload_image(func):
 def can_upload_variant(func):
     @wraps(func)
     def wrapper(request, *args, **kwargs):
-        if "Authorization" not in request.headers:
-            return HttpResponseForbidden()
-
-        authorization_key: Optional[AuthorizationKey] = AuthorizationKey.objects.filter(
-            id=request.headers["Authorization"], can_upload_variant=True
-        ).first()
-
-        if not authorization_key:
+        if not has_permission(request, "can_upload_variant"):
             return HttpResponseForbidden()
 
         return func(request, *args, **kwargs)
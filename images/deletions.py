@@ -0,0 +1,97 @@
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+from images.tasks import publisher
+from images.utils import get_s3_client
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of keys in a single DeleteObjects request
+S3_DELETE_BATCH_SIZE = 1000
+
+DELETE_OBJECTS_QUEUE = "kakigoori_delete_objects"
+
+
+def delete_s3_objects(keys: list[str]):
+    for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+        response = get_s3_client().delete_objects(
+            Bucket=settings.S3_BUCKET,
+            Delete={
+                "Objects": [
+                    {"Key": key} for key in keys[start : start + S3_DELETE_BATCH_SIZE]
+                ],
+                "Quiet": True,
+            },
+        )
+
+        for error in response.get("Errors", []):
+            logger.error(
+                "Failed to delete {}: {}".format(error["Key"], error.get("Message"))
+            )
+
+
+def flush_s3_deletions(keys: list[str]):
+    if settings.S3_DELETIONS_IN_BACKGROUND:
+        publisher.publish_batch(
+            [
+                (
+                    DELETE_OBJECTS_QUEUE,
+                    json.dumps(
+                        {"keys": keys[start : start + S3_DELETE_BATCH_SIZE]}
+                    ).encode("utf-8"),
+                )
+                for start in range(0, len(keys), S3_DELETE_BATCH_SIZE)
+            ]
+        )
+    else:
+        delete_s3_objects(keys)
+
+
+class PendingDeletions:
+    def __init__(self):
+        self.keys = []
+
+    def flush(self):
+        flush_s3_deletions(self.keys)
+
+
+_pending_deletions = threading.local()
+
+
+def schedule_s3_deletion(key: str, using: str):
+    # The objects are deleted once the transaction is committed, with one request for all the rows deleted in it.
+    # Django drops the callbacks registered in a savepoint that is rolled back, so the keys are grouped by savepoint,
+    # and a group whose callback was dropped is started again.
+    connection = transaction.get_connection(using)
+
+    if not connection.in_atomic_block:
+        flush_s3_deletions([key])
+        return
+
+    if not hasattr(_pending_deletions, "batches"):
+        _pending_deletions.batches = {}
+
+    # Django has no public API for either, so this relies on savepoint_ids, the ids of the open savepoints, and on
+    # run_on_commit holding (savepoint ids, callback, robust) tuples. tests/deletions_test.py fails if they change.
+    batch_key = (using, tuple(connection.savepoint_ids))
+    pending = _pending_deletions.batches.get(batch_key)
+
+    registered_callbacks = [func for _, func, _ in connection.run_on_commit]
+
+    if pending is None or pending.flush not in registered_callbacks:
+        # Groups of committed or rolled back transactions aren't needed anymore
+        _pending_deletions.batches = {
+            key: batch
+            for key, batch in _pending_deletions.batches.items()
+            if batch.flush in registered_callbacks
+        }
+
+        pending = PendingDeletions()
+        _pending_deletions.batches[batch_key] = pending
+        transaction.on_commit(pending.flush, using=using, robust=True)
+
+    pending.keys.append(key)
@@ -0,0 +1,325 @@
+import os
+import struct
+import subprocess
+import tempfile
+import threading
+import zlib
+from io import BytesIO
+
+GPS_INFO_TAG = 0x8825
+
+# Size in bytes of each TIFF field type
+TIFF_TYPE_SIZES = {
+    1: 1,
+    2: 1,
+    3: 2,
+    4: 4,
+    5: 8,
+    6: 1,
+    7: 1,
+    8: 2,
+    9: 4,
+    10: 8,
+    11: 4,
+    12: 8,
+    13: 4,
+}
+
+EXIF_HEADER = b"Exif\x00\x00"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_EXIF_TEXT_KEYWORDS = [b"Raw profile type exif", b"Raw profile type APP1"]
+
+
+class UnsupportedImage(Exception):
+    pass
+
+
+def check_bounds(tiff: bytearray, start: int, end: int):
+    if start < 0 or end > len(tiff):
+        raise UnsupportedImage("TIFF structure points outside of the EXIF data")
+
+
+def clear_ifd(tiff: bytearray, offset: int, byte_order: str):
+    check_bounds(tiff, offset, offset + 2)
+    (count,) = struct.unpack_from(f"{byte_order}H", tiff, offset)
+    ifd_end = offset + 2 + 12 * count + 4
+    check_bounds(tiff, offset, ifd_end)
+
+    for entry in range(offset + 2, offset + 2 + 12 * count, 12):
+        field_type, value_count, value_offset = struct.unpack_from(
+            f"{byte_order}HII", tiff, entry + 2
+        )
+        if field_type not in TIFF_TYPE_SIZES:
+            raise UnsupportedImage(f"Unknown TIFF field type {field_type}")
+
+        # Values of up to 4 bytes are stored in the entry itself, the others are stored elsewhere
+        size = TIFF_TYPE_SIZES[field_type] * value_count
+        if size > 4:
+            check_bounds(tiff, value_offset, value_offset + size)
+            tiff[value_offset : value_offset + size] = bytes(size)
+
+    tiff[offset:ifd_end] = bytes(ifd_end - offset)
+
+
+def strip_gps_from_tiff(tiff: bytearray) -> bool:
+    # The GPS IFD is cleared and its entry is removed from IFD0, without moving anything else, so that every other
+    # offset in the structure stays valid.
+    if tiff[:2] == b"II":
+        byte_order = "<"
+    elif tiff[:2] == b"MM":
+        byte_order = ">"
+    else:
+        raise UnsupportedImage("Invalid TIFF byte order")
+
+    check_bounds(tiff, 0, 8)
+    magic, ifd0_offset = struct.unpack_from(f"{byte_order}HI", tiff, 2)
+    if magic != 42:
+        raise UnsupportedImage("Invalid TIFF header")
+
+    check_bounds(tiff, ifd0_offset, ifd0_offset + 2)
+    (count,) = struct.unpack_from(f"{byte_order}H", tiff, ifd0_offset)
+    entries_start = ifd0_offset + 2
+    ifd0_end = entries_start + 12 * count + 4
+    check_bounds(tiff, ifd0_offset, ifd0_end)
+
+    for entry in range(entries_start, entries_start + 12 * count, 12):
+        (tag,) = struct.unpack_from(f"{byte_order}H", tiff, entry)
+        if tag != GPS_INFO_TAG:
+            continue
+
+        (gps_ifd_offset,) = struct.unpack_from(f"{byte_order}I", tiff, entry + 8)
+        clear_ifd(tiff, gps_ifd_offset, byte_order)
+
+        tiff[entry : ifd0_end - 12] = tiff[entry + 12 : ifd0_end]
+        tiff[ifd0_end - 12 : ifd0_end] = bytes(12)
+        struct.pack_into(f"{byte_order}H", tiff, ifd0_offset, count - 1)
+
+        return True
+
+    return False
+
+
+def read_exactly(file, size: int) -> bytes:
+    data = file.read(size)
+    if len(data) != size:
+        raise UnsupportedImage("Truncated file")
+    return data
+
+
+def strip_gps_from_jpeg(file, data: bytes, chunk_size: int):
+    # The metadata segments are all before the start of scan, they are kept in memory until it is found, and the
+    # image data is then streamed as is.
+    header = bytearray(data)
+    position = 2
+
+    def read_header_until(end):
+        while len(header) < end:
+            header.extend(read_exactly(file, min(chunk_size, end - len(header))))
+
+    while True:
+        read_header_until(position + 4)
+
+        if header[position] != 0xFF:
+            raise UnsupportedImage("Invalid JPEG marker")
+
+        marker = header[position + 1]
+        if marker == 0xFF:
+            # Fill byte
+            position += 1
+            continue
+
+        if marker in [0x01, 0xD8] or 0xD0 <= marker <= 0xD7:
+            position += 2
+            continue
+
+        if marker in [0xD9, 0xDA]:
+            break
+
+        (length,) = struct.unpack_from(">H", header, position + 2)
+        segment_start = position + 4
+        segment_end = position + 2 + length
+        read_header_until(segment_end)
+
+        if marker == 0xE1 and header.startswith(EXIF_HEADER, segment_start):
+            tiff_start = segment_start + len(EXIF_HEADER)
+            tiff = header[tiff_start:segment_end]
+
+            if strip_gps_from_tiff(tiff):
+                header[tiff_start:segment_end] = tiff
+
+        position = segment_end
+
+    yield bytes(header)
+    yield from iter(lambda: file.read(chunk_size), b"")
+
+
+def strip_gps_from_raw_profile(text: bytes) -> bytes | None:
+    # ImageMagick stores EXIF data in PNG text chunks, hex encoded after a header with the profile name and length
+    _, name, length, hex_data = text.split(b"\n", 3)
+
+    tiff = bytearray(bytes.fromhex(hex_data.decode("ascii")))
+    if tiff.startswith(EXIF_HEADER):
+        tiff = tiff[len(EXIF_HEADER) :]
+        header = EXIF_HEADER
+    else:
+        header = b""
+
+    if not strip_gps_from_tiff(tiff):
+        return None
+
+    # The new data has the same length, so it's written over the old one, keeping the original line breaks
+    new_hex = iter((header + tiff).hex().encode("ascii"))
+    new_hex_data = bytes(
+        next(new_hex) if character not in b"\n " else character
+        for character in hex_data
+    )
+
+    return b"\n".join([b"", name, length, new_hex_data])
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data))
+    )
+
+
+def strip_gps_from_png_chunk(chunk_type: bytes, data: bytes) -> bytes | None:
+    if chunk_type == b"eXIf":
+        tiff = bytearray(data)
+        # Some writers wrongly keep the JPEG EXIF header
+        header_length = len(EXIF_HEADER) if tiff.startswith(EXIF_HEADER) else 0
+        tiff = tiff[header_length:]
+        if strip_gps_from_tiff(tiff):
+            return data[:header_length] + tiff
+    else:
+        keyword, _, text = data.partition(b"\x00")
+        if keyword not in PNG_EXIF_TEXT_KEYWORDS:
+            return None
+
+        try:
+            if chunk_type == b"zTXt":
+                new_text = strip_gps_from_raw_profile(zlib.decompress(text[1:]))
+                if new_text is not None:
+                    new_text = text[:1] + zlib.compress(new_text)
+            else:
+                new_text = strip_gps_from_raw_profile(text)
+        except (ValueError, zlib.error):
+            raise UnsupportedImage("Invalid raw EXIF profile")
+
+        if new_text is not None:
+            return keyword + b"\x00" + new_text
+
+    return None
+
+
+def strip_gps_from_png(file, chunk_size: int):
+    # Only the chunks that can contain EXIF data are kept in memory, the other ones are streamed as is
+    yield PNG_SIGNATURE
+
+    while True:
+        chunk_header = file.read(8)
+        if len(chunk_header) < 8:
+            yield chunk_header
+            return
+
+        length, chunk_type = struct.unpack(">I4s", chunk_header)
+
+        if chunk_type in [b"eXIf", b"tEXt", b"zTXt"]:
+            data = read_exactly(file, length)
+            crc = read_exactly(file, 4)
+
+            new_data = strip_gps_from_png_chunk(chunk_type, data)
+            if new_data is None:
+                yield chunk_header + data + crc
+            else:
+                yield png_chunk(chunk_type, new_data)
+        else:
+            yield chunk_header
+
+            remaining = length + 4
+            while remaining > 0:
+                data = read_exactly(file, min(chunk_size, remaining))
+                remaining -= len(data)
+                yield data
+
+        if chunk_type == b"IEND":
+            break
+
+    yield from iter(lambda: file.read(chunk_size), b"")
+
+
+def strip_gps_chunks(file, chunk_size: int = 1024 * 1024):
+    signature = file.read(len(PNG_SIGNATURE))
+
+    if signature.startswith(b"\xff\xd8"):
+        yield from strip_gps_from_jpeg(file, signature, chunk_size)
+    elif signature == PNG_SIGNATURE:
+        yield from strip_gps_from_png(file, chunk_size)
+    else:
+        raise UnsupportedImage("Only JPEG and PNG images are supported")
+
+
+def strip_gps(image_data: bytes) -> bytes:
+    return b"".join(strip_gps_chunks(BytesIO(image_data)))
+
+
+class ExifTool:
+    # A single exiftool process kept open with -stay_open, as starting exiftool for every image is slow
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._process = None
+        self._pid = None
+
+    def _get_process(self):
+        if (
+            self._process is None
+            or self._process.poll() is not None
+            or self._pid != os.getpid()
+        ):
+            self._process = subprocess.Popen(
+                ["exiftool", "-stay_open", "True", "-@", "-"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+            self._pid = os.getpid()
+
+        return self._process
+
+    def remove_gps(self, image_data: bytes) -> bytes:
+        with tempfile.TemporaryDirectory() as directory:
+            input_path = os.path.join(directory, "input")
+            output_path = os.path.join(directory, "output")
+
+            with open(input_path, "wb") as input_file:
+                input_file.write(image_data)
+
+            with self._lock:
+                process = self._get_process()
+                process.stdin.write(
+                    f"-gps:all=\n-o\n{output_path}\n{input_path}\n-execute\n".encode(
+                        "utf-8"
+                    )
+                )
+                process.stdin.flush()
+
+                output = b""
+                while not output.endswith(b"{ready}\n"):
+                    line = process.stdout.readline()
+                    if not line:
+                        self._process = None
+                        raise Exception("exiftool exited unexpectedly")
+                    output += line
+
+            if not os.path.exists(output_path):
+                raise Exception(output.decode("utf-8", errors="replace"))
+
+            with open(output_path, "rb") as output_file:
+                return output_file.read()
+
+
+exiftool = ExifTool()
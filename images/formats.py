@@ -0,0 +1,192 @@
+import logging
+import random
+
+import valkey
+from django.conf import settings
+
+from images.utils import get_valkey_client
+
+logger = logging.getLogger(__name__)
+
+OPTIMIZED_FILE_TYPES = ["avif", "webp"]
+
+# Observed sizes of the optimized variants compared to their source, and the encodes skipped because of them, for
+# each bucket of similar variants
+FORMAT_SAVINGS_KEY = "kakigoori:format_policy:savings"
+FORMAT_SKIPPED_KEY = "kakigoori:format_policy:skipped"
+
+
+def format_bucket(
+    file_type: str, width: int, height: int, gaussian_blur: float, source_file_type: str
+) -> str:
+    # Pixel counts are grouped by powers of 4, e.g. 600x300 and 1000x500 are in the same bucket. Only png sources
+    # can be transparent.
+    pixels_bucket = (width * height).bit_length() // 2
+    blur = "blurred" if gaussian_blur else "sharp"
+    transparency = "transparent" if source_file_type == "png" else "opaque"
+
+    return f"{file_type}:{pixels_bucket}:{blur}:{transparency}"
+
+
+def parse_bucket_fields(fields: dict[bytes, bytes]) -> dict[str, dict[str, float]]:
+    buckets = {}
+    for field, value in fields.items():
+        bucket, name = field.decode("utf-8").rsplit(":", 1)
+        buckets.setdefault(bucket, {})[name] = float(value)
+
+    return buckets
+
+
+def get_observed_savings(buckets: list[str]) -> dict[str, tuple[int, float]]:
+    client = get_valkey_client()
+    if client is None:
+        return {}
+
+    fields = [
+        f"{bucket}:{name}"
+        for bucket in buckets
+        for name in ["count", "source_bytes", "result_bytes"]
+    ]
+
+    try:
+        values = client.hmget(FORMAT_SAVINGS_KEY, fields)
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to read the format savings")
+        return {}
+
+    observed_savings = {}
+    for position, bucket in enumerate(buckets):
+        count, source_bytes, result_bytes = [
+            int(value or 0) for value in values[position * 3 : position * 3 + 3]
+        ]
+        if count and source_bytes:
+            observed_savings[bucket] = (count, 1 - result_bytes / source_bytes)
+
+    return observed_savings
+
+
+def optimized_file_types(variant) -> list[str]:
+    # Optimized formats are only skipped once enough of the same kind of variants have been encoded to know they
+    # don't pay off. A few of them are still encoded, so the observed savings keep following the encoders.
+    if not settings.FORMAT_POLICY or variant.file_size is None:
+        return OPTIMIZED_FILE_TYPES
+
+    buckets = {
+        file_type: format_bucket(
+            file_type,
+            variant.width,
+            variant.height,
+            variant.gaussian_blur,
+            variant.file_type,
+        )
+        for file_type in OPTIMIZED_FILE_TYPES
+    }
+    observed_savings = get_observed_savings(list(buckets.values()))
+
+    file_types = []
+    skipped = {}
+
+    for file_type, bucket in buckets.items():
+        count, savings = observed_savings.get(bucket, (0, None))
+
+        if (
+            count < settings.FORMAT_POLICY_MIN_SAMPLES
+            # Nothing observed yet, which FORMAT_POLICY_MIN_SAMPLES=0 doesn't catch
+            or savings is None
+            or random.random() < settings.FORMAT_POLICY_EXPLORATION
+            or (
+                savings >= settings.FORMAT_POLICY_MIN_SAVINGS
+                and variant.file_size * savings
+                >= settings.FORMAT_POLICY_MIN_SAVED_BYTES
+            )
+        ):
+            file_types.append(file_type)
+        else:
+            # The storage avoided is the size the skipped variant would have had
+            skipped[bucket] = int(variant.file_size * (1 - savings))
+
+    if skipped:
+        record_skipped_encodes(skipped)
+
+    return file_types
+
+
+def record_skipped_encodes(skipped: dict[str, int]):
+    client = get_valkey_client()
+    if client is None:
+        return
+
+    try:
+        pipeline = client.pipeline(transaction=False)
+        for bucket, avoided_bytes in skipped.items():
+            pipeline.hincrby(FORMAT_SKIPPED_KEY, f"{bucket}:count", 1)
+            pipeline.hincrby(
+                FORMAT_SKIPPED_KEY, f"{bucket}:avoided_bytes", avoided_bytes
+            )
+        pipeline.execute()
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to record the skipped encodes")
+
+
+def record_format_savings(results: list[tuple[str, int, int, float | None]]):
+    # Each result is the bucket of an optimized variant, the size of its source, its own size, and the time the
+    # worker took to encode it when it reports it
+    client = get_valkey_client()
+    if client is None or not results:
+        return
+
+    try:
+        pipeline = client.pipeline(transaction=False)
+        for bucket, source_bytes, result_bytes, encode_seconds in results:
+            pipeline.hincrby(FORMAT_SAVINGS_KEY, f"{bucket}:count", 1)
+            pipeline.hincrby(FORMAT_SAVINGS_KEY, f"{bucket}:source_bytes", source_bytes)
+            pipeline.hincrby(FORMAT_SAVINGS_KEY, f"{bucket}:result_bytes", result_bytes)
+            if encode_seconds is not None:
+                pipeline.hincrby(FORMAT_SAVINGS_KEY, f"{bucket}:timed", 1)
+                pipeline.hincrbyfloat(
+                    FORMAT_SAVINGS_KEY, f"{bucket}:encode_seconds", encode_seconds
+                )
+        pipeline.execute()
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to record the format savings")
+
+
+def get_format_policy_report() -> list[dict[str, str | int | float]] | None:
+    client = get_valkey_client()
+    if client is None:
+        return None
+
+    savings = parse_bucket_fields(client.hgetall(FORMAT_SAVINGS_KEY))
+    skipped = parse_bucket_fields(client.hgetall(FORMAT_SKIPPED_KEY))
+
+    report = []
+    for bucket in sorted(savings.keys() | skipped.keys()):
+        observed = savings.get(bucket, {})
+        bucket_skipped = skipped.get(bucket, {})
+
+        source_bytes = observed.get("source_bytes", 0)
+        timed = observed.get("timed", 0)
+        encode_seconds = observed.get("encode_seconds", 0) / timed if timed else None
+        skipped_count = int(bucket_skipped.get("count", 0))
+
+        report.append(
+            {
+                "bucket": bucket,
+                "samples": int(observed.get("count", 0)),
+                "savings": (
+                    1 - observed.get("result_bytes", 0) / source_bytes
+                    if source_bytes
+                    else None
+                ),
+                "encode_seconds": encode_seconds,
+                "skipped": skipped_count,
+                "avoided_bytes": int(bucket_skipped.get("avoided_bytes", 0)),
+                "avoided_cpu_seconds": (
+                    skipped_count * encode_seconds
+                    if encode_seconds is not None
+                    else None
+                ),
+            }
+        )
+
+    return report
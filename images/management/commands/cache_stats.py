@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from images.cache import get_variant_cache_stats
+from images.originals_cache import get_originals_cache_stats
+from images.sizes import get_size_ladder_stats
+
+
+class Command(BaseCommand):
+    def handle(self, *args, **options):
+        stats = get_variant_cache_stats()
+
+        if stats is None:
+            print("Cache statistics are disabled, set VALKEY_URL to enable them")
+            return
+
+        print("Variant cache")
+        print(f"Lookups: {stats['lookups']}")
+        print(f"Hits: {stats['hits']}")
+        print(f"Misses: {stats['misses']}")
+        print(f"Hit ratio: {stats['hit_ratio']:.2%}")
+
+        stats = get_originals_cache_stats()
+
+        print("")
+        print("Originals cache")
+        if stats is None:
+            print("Failed to read the statistics")
+        else:
+            print(f"Lookups: {stats['lookups']}")
+            print(f"Hits: {stats['hits']}")
+            print(f"Misses: {stats['misses']}")
+            print(f"Hit ratio: {stats['hit_ratio']:.2%}")
+            print(f"Bytes saved: {stats['bytes_saved']}")
+
+        stats = get_size_ladder_stats()
+
+        print("")
+        print("Size ladder")
+        if stats is None:
+            print("Failed to read the statistics")
+        else:
+            print(f"Snapped requests: {stats['snapped']}")
+            print(f"Distinct sizes requested: {stats['requested_sizes']}")
+            print(f"Distinct sizes served: {stats['served_sizes']}")
+            print(f"Sizes collapsed: {stats['collapsed_sizes']}")
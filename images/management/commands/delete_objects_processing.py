@@ -0,0 +1,34 @@
+import json
+
+import pika
+from django.core.management.base import BaseCommand
+import logging
+
+from images.deletions import DELETE_OBJECTS_QUEUE, delete_s3_objects
+from kakigoori import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    def handle(self, *args, **options):
+        connection = pika.BlockingConnection(settings.RABBITMQ_CONNECTION_PARAMETERS)
+
+        channel = connection.channel()
+        channel.queue_declare(queue=DELETE_OBJECTS_QUEUE, durable=True)
+
+        def callback(ch, method, properties, body):
+            args = json.loads(body.decode("utf-8"))
+
+            logger.info("Deleting {} objects".format(len(args["keys"])))
+
+            delete_s3_objects(args["keys"])
+
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+
+        channel.basic_qos(prefetch_count=1)
+        channel.basic_consume(queue=DELETE_OBJECTS_QUEUE, on_message_callback=callback)
+
+        logger.info("Ready to process")
+
+        channel.start_consuming()
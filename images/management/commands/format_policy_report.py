@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from images.formats import get_format_policy_report
+
+
+def format_optional(value, format_spec):
+    return "-" if value is None else format(value, format_spec)
+
+
+class Command(BaseCommand):
+    help = "Shows the savings of the optimized formats, and the encodes skipped by the format policy"
+
+    def handle(self, *args, **options):
+        report = get_format_policy_report()
+
+        if report is None:
+            print("The format policy needs Valkey, set VALKEY_URL to enable it")
+            return
+
+        print(
+            f"{'Bucket':<32} {'Samples':>8} {'Savings':>8} {'Encode':>8} {'Skipped':>8} "
+            f"{'Storage avoided':>16} {'CPU avoided':>12}"
+        )
+
+        for row in report:
+            print(
+                f"{row['bucket']:<32} {row['samples']:>8} "
+                f"{format_optional(row['savings'], '.1%'):>8} "
+                f"{format_optional(row['encode_seconds'], '.2f'):>7}s "
+                f"{row['skipped']:>8} {row['avoided_bytes']:>16} "
+                f"{format_optional(row['avoided_cpu_seconds'], '.0f'):>11}s"
+            )
+
+        print("")
+        print(f"Encodes skipped: {sum(row['skipped'] for row in report)}")
+        print(f"Storage avoided: {sum(row['avoided_bytes'] for row in report)} bytes")
+        print(
+            "Encoder CPU avoided: {:.0f} s".format(
+                sum(row["avoided_cpu_seconds"] or 0 for row in report)
+            )
+        )
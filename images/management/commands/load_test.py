@@ -0,0 +1,51 @@
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Sends concurrent requests to image URLs and reports the throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument("urls", nargs="+")
+        parser.add_argument("--concurrency", type=int, default=50)
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument(
+            "--follow-redirects",
+            action="store_true",
+            help="Measure the time until the image is downloaded, to compare the serving modes",
+        )
+
+    def handle(self, *args, **options):
+        urls = options["urls"]
+        sessions = threading.local()
+
+        def send_request(number):
+            if not hasattr(sessions, "session"):
+                sessions.session = requests.Session()
+
+            start = time.perf_counter()
+            # Unless they are followed, redirects only measure the time spent in Kakigoori
+            response = sessions.session.get(
+                urls[number % len(urls)], allow_redirects=options["follow_redirects"]
+            )
+            return response.status_code, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            results = list(executor.map(send_request, range(options["requests"])))
+        duration = time.perf_counter() - start
+
+        latencies = sorted(latency for _, latency in results)
+        errors = sum(1 for status_code, _ in results if status_code >= 400)
+
+        print(f"Requests: {len(results)} ({errors} errors)")
+        print(f"Concurrency: {options['concurrency']}")
+        print(f"Throughput: {len(results) / duration:.1f} requests/s")
+        print(f"Latency p50: {statistics.median(latencies) * 1000:.1f} ms")
+        print(f"Latency p95: {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms")
+        print(f"Latency p99: {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
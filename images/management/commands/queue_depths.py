@@ -0,0 +1,40 @@
+import pika
+from django.core.management.base import BaseCommand
+
+from images.tasks import JOB_CLASSES, job_class_queue
+from kakigoori import settings
+
+WORKER_QUEUES = ["kakigoori_avif", "kakigoori_webp", "kakigoori_all"]
+
+
+class Command(BaseCommand):
+    help = "Shows the number of tasks waiting for the worker, for each job class"
+
+    def handle(self, *args, **options):
+        connection = pika.BlockingConnection(settings.RABBITMQ_CONNECTION_PARAMETERS)
+        channel = connection.channel()
+
+        for queue in WORKER_QUEUES:
+            print(queue)
+
+            for job_class in JOB_CLASSES:
+                try:
+                    result = channel.queue_declare(
+                        queue=job_class_queue(queue, job_class),
+                        durable=True,
+                        passive=True,
+                    )
+                except pika.exceptions.ChannelClosedByBroker:
+                    # The queue doesn't exist yet, and the broker closed the channel
+                    channel = connection.channel()
+                    print(f"{job_class}: -")
+                    continue
+
+                print(
+                    f"{job_class}: {result.method.message_count} messages, "
+                    f"{result.method.consumer_count} consumers"
+                )
+
+            print("")
+
+        connection.close()
@@ -1,84 +1,293 @@
+import json
 import logging
-from io import BytesIO
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
 
+import django
 from django.core.management.base import BaseCommand
 
-from images.models import Image
-from images.tasks import send_image_to_worker
-from images.utils import get_b2_resource
+from images.models import Image, ImageVariant
+from images.tasks import BULK, JOB_CLASSES, send_images_to_worker
+from images.utils import get_s3_client
+from kakigoori import settings
 
 logger = logging.getLogger(__name__)
 
 
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self, calls=1):
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(self.next_call, now) + self.interval * calls
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+rate_limiters = {}
+
+
+def get_rate_limiter(name, rate):
+    # Each process of the pool has its own limiters, created on their first use
+    if name not in rate_limiters:
+        rate_limiters[name] = RateLimiter(rate)
+
+    return rate_limiters[name]
+
+
+def regenerate_image(image, variants, file_types, s3_rate, broker_rate, job_class):
+    # The variants are given by the parent process, so they are matched with their source here instead of running
+    # a query for each of them
+    s3_rate_limiter = get_rate_limiter("s3", s3_rate)
+    broker_rate_limiter = get_rate_limiter("broker", broker_rate)
+
+    regenerated = 0
+    failed = 0
+
+    sources = {
+        (v.width, v.height, v.gaussian_blur, v.brightness): v
+        for v in variants
+        if v.file_type in ["jpg", "png"]
+    }
+
+    optimized_variants_by_source = {}
+    # The jpg and png variants are regenerated from the original, whatever they were first resized from
+    resized_from_original = []
+
+    for variant in variants:
+        if file_types and variant.file_type not in file_types:
+            continue
+
+        if variant.file_type in ["webp", "avif"]:
+            source = sources.get(
+                (
+                    variant.width,
+                    variant.height,
+                    variant.gaussian_blur,
+                    variant.brightness,
+                )
+            )
+            if source is None:
+                logger.error(f"No source found for variant {variant.id}")
+                failed += 1
+                continue
+
+            optimized_variants_by_source.setdefault(source, []).append(variant)
+            continue
+
+        if variant.is_full_size:
+            continue
+
+        try:
+            s3_rate_limiter.wait()
+            resized_image, file_extension = image.create_resized_image(
+                variant.height,
+                variant.width,
+                variant.gaussian_blur,
+                variant.brightness,
+            )
+
+            if file_extension == "jpg":
+                content_type = "image/jpeg"
+            elif file_extension == "png":
+                content_type = "image/png"
+            else:
+                content_type = "binary/octet-stream"
+
+            variant.file_type = file_extension
+
+            s3_rate_limiter.wait()
+            get_s3_client().upload_fileobj(
+                resized_image,
+                settings.S3_BUCKET,
+                variant.s3_filepath,
+                ExtraArgs={"ContentType": content_type},
+            )
+            resized_from_original.append(variant.id)
+            regenerated += 1
+        except Exception:
+            logger.exception(f"Failed to regenerate variant {variant.id}")
+            failed += 1
+
+    primary_variant = next((v for v in variants if v.is_primary_variant), None)
+    if resized_from_original and primary_variant is not None:
+        ImageVariant.objects.filter(id__in=resized_from_original).update(
+            source_variant=primary_variant, derived_from_primary=True
+        )
+
+    # Each source is only downloaded once, and only kept until its optimized variants are sent
+    for source, optimized_variants in optimized_variants_by_source.items():
+        # The worker reads the source from S3 itself otherwise
+        image_data = None
+
+        try:
+            if (
+                settings.WORKER_TASK_PROTOCOL == 1
+                or settings.WORKER_SHARED_STORAGE_PATH
+            ):
+                s3_rate_limiter.wait()
+                image_data = image.download_variant(source)
+
+            broker_rate_limiter.wait(len(optimized_variants))
+            send_images_to_worker(optimized_variants, image_data, job_class)
+            regenerated += len(optimized_variants)
+        except Exception:
+            logger.exception(f"Failed to send the variants of source {source.id}")
+            failed += len(optimized_variants)
+        finally:
+            # Sources from the originals cache are memory maps of the cached file
+            if image_data is not None:
+                image_data.close()
+
+    return regenerated, failed
+
+
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("--images", nargs="+", type=str, required=False)
+        parser.add_argument("--versions", nargs="+", type=int)
+        parser.add_argument(
+            "--formats", nargs="+", choices=["jpg", "png", "webp", "avif"]
+        )
+        parser.add_argument("--created-after", type=date.fromisoformat)
+        parser.add_argument("--created-before", type=date.fromisoformat)
+        parser.add_argument("--workers", type=int, default=1)
+        parser.add_argument("--chunk-size", type=int, default=200)
+        parser.add_argument(
+            "--checkpoint",
+            help="File where the progress is saved, the command resumes from it when it exists",
+        )
+        parser.add_argument(
+            "--s3-rate", type=float, help="Maximum S3 requests per second"
+        )
+        parser.add_argument(
+            "--broker-rate", type=float, help="Maximum RabbitMQ messages per second"
+        )
+        parser.add_argument(
+            "--job-class",
+            choices=JOB_CLASSES,
+            default=BULK,
+            help="Job class of the encodes, bulk ones are only done when there are no uploads waiting",
+        )
 
     def handle(self, *args, **options):
-        if options["images"] and len(options["images"]) > 0:
-            images_list = Image.objects.filter(id__in=options["images"])
+        images_list = Image.objects.all()
+
+        if options["images"]:
+            images_list = images_list.filter(id__in=options["images"])
+        if options["versions"]:
+            images_list = images_list.filter(version__in=options["versions"])
+        if options["created_after"]:
+            images_list = images_list.filter(
+                creation_date__date__gte=options["created_after"]
+            )
+        if options["created_before"]:
+            images_list = images_list.filter(
+                creation_date__date__lte=options["created_before"]
+            )
+
+        checkpoint = options["checkpoint"]
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as checkpoint_file:
+                last_image_id = json.load(checkpoint_file)["last_image_id"]
+
+            print(f"Resuming after image {last_image_id}")
+            images_list = images_list.filter(id__gt=last_image_id)
+
+        images_list = images_list.order_by("id")
+        total = images_list.count()
+
+        workers = options["workers"]
+        # The rates are shared between the processes of the pool
+        s3_rate = options["s3_rate"] / workers if options["s3_rate"] else None
+        broker_rate = (
+            options["broker_rate"] / workers if options["broker_rate"] else None
+        )
+
+        if workers > 1:
+            # Spawned processes don't share the database and broker connections of this one, unlike forked ones
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=django.setup,
+            )
         else:
-            images_list = Image.objects.all()
-
-        bucket = get_b2_resource()
-
-        for image in images_list:
-            image_downloaded = {}
-
-            for variant in image.imagevariant_set.all():
-                print(f"Processing variant {variant.id}")
-
-                if variant.is_full_size and (
-                    variant.file_type == "jpg" or variant.file_type == "png"
-                ):
-                    print("Can't regenerate original image")
-                    continue
-
-                if variant.file_type == "webp" or variant.file_type == "avif":
-                    if (
-                        str(variant.parent_variant_for_optimized_versions.id)
-                        in image_downloaded
-                    ):
-                        image_data = image_downloaded[
-                            str(variant.parent_variant_for_optimized_versions.id)
-                        ]
-                    else:
-                        image_data = BytesIO()
-                        try:
-                            bucket.download_fileobj(
-                                variant.parent_variant_for_optimized_versions.s3_filepath,
-                                image_data,
-                            )
-                        except:
-                            continue
-                        image_downloaded[
-                            str(variant.parent_variant_for_optimized_versions.id)
-                        ] = image_data
-
-                    image_data.seek(0)
-                    send_image_to_worker(image_variant=variant, image_data=image_data)
-                    continue
-                try:
-                    image, file_extension = variant.image.create_resized_image(
-                        variant.height,
-                        variant.width,
-                        variant.gaussian_blur,
-                        variant.brightness,
-                    )
-                except:
-                    continue
-
-                if file_extension == "jpg":
-                    content_type = "image/jpeg"
-                elif file_extension == "png":
-                    content_type = "image/png"
-                else:
-                    content_type = "binary/octet-stream"
-
-                variant.file_type = file_extension
-
-                bucket.upload_fileobj(
+            executor = None
+
+        done = 0
+        regenerated = 0
+        failed = 0
+        started_at = time.monotonic()
+
+        chunk = []
+
+        def process_chunk():
+            nonlocal done, regenerated, failed
+
+            jobs = [
+                (
                     image,
-                    variant.s3_filepath,
-                    ExtraArgs={"ContentType": content_type},
+                    list(image.imagevariant_set.all()),
+                    options["formats"],
+                    s3_rate,
+                    broker_rate,
+                    options["job_class"],
                 )
+                for image in chunk
+            ]
+
+            if executor:
+                results = executor.map(regenerate_image, *zip(*jobs))
+            else:
+                results = (regenerate_image(*job) for job in jobs)
+
+            for chunk_regenerated, chunk_failed in results:
+                regenerated += chunk_regenerated
+                failed += chunk_failed
+
+            done += len(chunk)
+
+            # The checkpoint only moves once every image before it has been processed
+            if checkpoint:
+                with open(f"{checkpoint}.tmp", "w") as checkpoint_file:
+                    json.dump({"last_image_id": str(chunk[-1].id)}, checkpoint_file)
+                os.replace(f"{checkpoint}.tmp", checkpoint)
+
+            elapsed = time.monotonic() - started_at
+            eta = elapsed / done * (total - done)
+            print(
+                f"{done}/{total} images, {regenerated} variants regenerated, {failed} failed, "
+                f"{done / elapsed:.1f} images/s, ETA {eta / 60:.0f} min"
+            )
+
+            chunk.clear()
+
+        try:
+            for image in images_list.prefetch_related("imagevariant_set").iterator(
+                chunk_size=options["chunk_size"]
+            ):
+                chunk.append(image)
+
+                if len(chunk) >= options["chunk_size"]:
+                    process_chunk()
+
+            if chunk:
+                process_chunk()
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+
+        print(f"Done: {regenerated} variants regenerated, {failed} failed")
@@ -0,0 +1,74 @@
+import json
+
+import pika
+from django.core.management.base import BaseCommand
+import logging
+
+from images.cache import clear_resize_pending
+from images.models import Image, VariantCreationTimeout
+from images.tasks import BACKGROUND
+from kakigoori import settings
+
+import django
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    def handle(self, *args, **options):
+        connection = pika.BlockingConnection(settings.RABBITMQ_CONNECTION_PARAMETERS)
+
+        channel = connection.channel()
+        channel.queue_declare(queue="kakigoori_resize", durable=True)
+
+        def callback(ch, method, properties, body):
+            args = json.loads(body.decode("utf-8"))
+
+            image_id = args["image_id"]
+            width = args["width"]
+            height = args["height"]
+            gaussian_blur = args["gaussian_blur"]
+            brightness = args["brightness"]
+
+            logger.info("Resizing image {} to {}x{}".format(image_id, width, height))
+
+            try:
+                image = Image.objects.filter(id=image_id).first()
+            except django.core.exceptions.ValidationError:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                return
+            if not image:
+                logger.error("Image not found")
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                return
+
+            try:
+                # The client was already served a fallback, so the encodes can wait for the uploads
+                image.create_variant(
+                    width, height, gaussian_blur, brightness, job_class=BACKGROUND
+                )
+            except VariantCreationTimeout:
+                # Someone else is already creating this variant
+                pass
+            except Exception:
+                # The task is dropped rather than requeued, so a failing image can't block the queue. Clearing the
+                # marker lets the next request for this size send a new one.
+                logger.exception(
+                    "Failed to resize image {} to {}x{}".format(image_id, width, height)
+                )
+                clear_resize_pending(image.id, width, height, gaussian_blur, brightness)
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                return
+
+            clear_resize_pending(image.id, width, height, gaussian_blur, brightness)
+
+            logger.info("Resized image {} to {}x{}".format(image_id, width, height))
+
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+
+        channel.basic_qos(prefetch_count=1)
+        channel.basic_consume(queue="kakigoori_resize", on_message_callback=callback)
+
+        logger.info("Ready to process")
+
+        channel.start_consuming()
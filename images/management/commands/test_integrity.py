@@ -1,118 +1,322 @@
-from django.core.management.base import BaseCommand
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from images.models import Image
-from images.utils import get_b2_resource
 import botocore
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Exists, OuterRef
 
+from images.models import Image, ImageVariant
+from images.utils import get_s3_client
+from kakigoori import settings
 
-class Command(BaseCommand):
-    bucket = None
 
-    def __init__(self):
-        self.bucket = get_b2_resource()
-        super(Command, self).__init__()
+def get_etag(variant):
+    try:
+        response = get_s3_client().head_object(
+            Bucket=settings.S3_BUCKET, Key=variant.s3_filepath
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] == "404":
+            return None
+        raise
+
+    return response["ETag"][1:-1]
+
+
+def bucket_keys():
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=settings.S3_BUCKET):
+        for s3_object in page.get("Contents", []):
+            yield s3_object["Key"]
+
+
+def variant_keys():
+    # Keys start with the hex of the variant id, so ordering by id gives the same order as the bucket listing
+    variants = (
+        ImageVariant.objects.filter(available=True)
+        .order_by("id")
+        .values_list("id", "file_type")
+        .iterator(chunk_size=10000)
+    )
+
+    for variant_id, file_type in variants:
+        yield (
+            f"{variant_id.hex[:2]}/{variant_id.hex[2:4]}/{variant_id.hex}.{file_type}",
+            variant_id,
+        )
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the problems, without self-healing them",
+        )
+        parser.add_argument("--report", help="Write a JSON report to this file")
+        parser.add_argument(
+            "--check-s3",
+            action="store_true",
+            help="Compare the whole bucket with the available variants",
+        )
+        parser.add_argument("--concurrency", type=int, default=32)
 
     def test_image_has_variants(self):
-        return Image.objects.filter(imagevariant=None).all()
+        return list(
+            Image.objects.filter(
+                ~Exists(ImageVariant.objects.filter(image=OuterRef("pk")))
+            ).values_list("id", flat=True)
+        )
 
-    def test_primary_variant_every_image_has_only_one(self):
+    def test_primary_variant_every_image_has_only_one(self, dry_run, concurrency):
         images_with_problems = []
+        self_healed = []
+        variants_to_delete = []
 
-        for image in Image.objects.all():
-            image_variant_set = image.imagevariant_set.filter(is_primary_variant=True)
-            if image_variant_set.count() > 1:
-                found_etags = []
-                for image_variant in image_variant_set.all():
-                    try:
-                        e_tag = self.bucket.Object(image_variant.s3_filepath).e_tag[
-                            1:-1
-                        ]
-                    except botocore.exceptions.ClientError as e:
-                        if e.response["Error"]["Code"] == "404":
-                            print(f"Variant {image_variant.id} not found, deleting...")
-                            image_variant.delete()
-                            continue
-                        else:
-                            raise
-
-                    if e_tag in found_etags:
-                        image_variant.delete()
-                    else:
-                        found_etags.append(e_tag)
-
-                if len(found_etags) > 1:
-                    images_with_problems.append(image.id)
+        image_ids = (
+            ImageVariant.objects.filter(is_primary_variant=True)
+            .values("image_id")
+            .annotate(primary_variants=Count("id"))
+            .filter(primary_variants__gt=1)
+            .values_list("image_id", flat=True)
+        )
+
+        primary_variants = {}
+        for variant in ImageVariant.objects.filter(
+            image_id__in=image_ids, is_primary_variant=True
+        ).order_by("image_id", "id"):
+            primary_variants.setdefault(variant.image_id, []).append(variant)
+
+        variants = [v for image in primary_variants.values() for v in image]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            etags = dict(zip(variants, executor.map(get_etag, variants)))
+
+        for image_id, image_variants in primary_variants.items():
+            found_etags = []
+            duplicates = []
+
+            for variant in image_variants:
+                e_tag = etags[variant]
+
+                if e_tag is None:
+                    print(f"Variant {variant.id} not found")
+                    duplicates.append(variant)
+                elif e_tag in found_etags:
+                    duplicates.append(variant)
+                else:
+                    found_etags.append(e_tag)
+
+            if len(found_etags) != 1:
+                # Either different files, or none of them are in S3, in which case there is nothing left to keep
+                images_with_problems.append(
+                    {
+                        "image_id": image_id,
+                        "variants": [
+                            variant.id
+                            for variant in image_variants
+                            if variant not in duplicates or not found_etags
+                        ],
+                    }
+                )
+                if found_etags:
+                    variants_to_delete.extend(duplicates)
+            else:
+                variants_to_delete.extend(duplicates)
+
+                if dry_run:
+                    print(
+                        f"Image {image_id} has multiple primary variants, but all of them are identical. All but the first one would be deleted"
+                    )
                 else:
+                    self_healed.append(image_id)
                     print(
-                        f"SELF-HEALED: Image {image.id} had multiple primary variants, but all of them were identical. We only kept the first one, and deleted the others"
+                        f"SELF-HEALED: Image {image_id} had multiple primary variants, but all of them were identical. We only kept the first one, and deleted the others"
                     )
 
-        return images_with_problems
+        if not dry_run:
+            # A single delete, so that the files are removed from S3 in batches once it is committed
+            ImageVariant.objects.filter(
+                id__in=[variant.id for variant in variants_to_delete]
+            ).delete()
+
+        return images_with_problems, self_healed
 
-    def test_every_image_has_primary_variant(self):
+    def test_every_image_has_primary_variant(self, dry_run):
         images_with_problems = []
+        self_healed = []
 
-        for image in Image.objects.all():
-            if image.imagevariant_set.filter(is_primary_variant=True).count() == 0:
-                image_variants = image.imagevariant_set.filter(
-                    is_full_size=True,
-                    file_type__in=["jpg", "png"],
-                    gaussian_blur=0,
-                    brightness=1,
+        image_ids = Image.objects.filter(
+            ~Exists(
+                ImageVariant.objects.filter(
+                    image=OuterRef("pk"), is_primary_variant=True
                 )
-                if image_variants.count() == 1:
-                    image_variants.update(is_primary_variant=True)
+            )
+        ).values_list("id", flat=True)
+
+        candidates = {}
+        for image_id, variant_id in ImageVariant.objects.filter(
+            image_id__in=image_ids,
+            is_full_size=True,
+            file_type__in=["jpg", "png"],
+            gaussian_blur=0,
+            brightness=1,
+        ).values_list("image_id", "id"):
+            candidates.setdefault(image_id, []).append(variant_id)
+
+        new_primary_variants = []
+        for image_id in image_ids:
+            if len(candidates.get(image_id, [])) == 1:
+                new_primary_variants.append(candidates[image_id][0])
+
+                if dry_run:
                     print(
-                        f"SELF-HEALED: Image {image.id} had no primary variant, we assigned one"
+                        f"Image {image_id} has no primary variant, one would be assigned"
                     )
                 else:
-                    images_with_problems.append(image)
+                    self_healed.append(image_id)
+                    print(
+                        f"SELF-HEALED: Image {image_id} had no primary variant, we assigned one"
+                    )
+            else:
+                images_with_problems.append(image_id)
+
+        if not dry_run:
+            ImageVariant.objects.filter(id__in=new_primary_variants).update(
+                is_primary_variant=True
+            )
+
+        return images_with_problems, self_healed
 
-        return images_with_problems
+    def test_s3_matches_variants(self):
+        # Merge join of the bucket listing and of the variants, both sorted by key
+        missing_from_s3 = []
+        not_in_database = []
+
+        keys = bucket_keys()
+        variants = variant_keys()
+
+        key = next(keys, None)
+        variant = next(variants, None)
+
+        while key is not None or variant is not None:
+            if variant is None or (key is not None and key < variant[0]):
+                not_in_database.append(key)
+                key = next(keys, None)
+            elif key is None or variant[0] < key:
+                missing_from_s3.append(variant[1])
+                variant = next(variants, None)
+            else:
+                key = next(keys, None)
+                variant = next(variants, None)
+
+        return missing_from_s3, not_in_database
 
     def handle(self, *args, **options):
+        dry_run = options["dry_run"]
+        report = {"dry_run": dry_run, "checks": {}}
+
+        def add_to_report(check, started_at, **results):
+            report["checks"][check] = {
+                "duration": time.monotonic() - started_at,
+                **results,
+            }
+
         print("Testing integrity")
 
         print("Testing that all images have variants")
 
+        started_at = time.monotonic()
         problems = self.test_image_has_variants()
 
         if problems:
             print(f"FAIL, the following images don't have any variants:")
             for problem in problems:
-                print(f"- {problem.id}")
+                print(f"- {problem}")
 
-            print("Self-healing...")
+            if not dry_run:
+                print("Self-healing...")
 
-            for problem in problems:
-                problem.delete()
+                Image.objects.filter(id__in=problems).delete()
 
-            print("Done")
+                print("Done")
         else:
             print("OK")
 
+        add_to_report(
+            "image_has_variants",
+            started_at,
+            problems=problems,
+            self_healed=problems if not dry_run else [],
+        )
+
         print("Testing if every image has only one primary variant...")
 
-        problems = self.test_primary_variant_every_image_has_only_one()
+        started_at = time.monotonic()
+        problems, self_healed = self.test_primary_variant_every_image_has_only_one(
+            dry_run, options["concurrency"]
+        )
 
         if problems:
             print(f"FAIL")
             for problem in problems:
-                print(f"Image {problem.id} has the following variants:")
-                for variant in problem.imagevariant_set.filter(
-                    is_primary_variant=True
-                ).all():
-                    print(f"- {variant.id}")
+                print(f"Image {problem['image_id']} has the following variants:")
+                for variant_id in problem["variants"]:
+                    print(f"- {variant_id}")
         else:
             print("OK")
 
+        add_to_report(
+            "only_one_primary_variant",
+            started_at,
+            problems=problems,
+            self_healed=self_healed,
+        )
+
         print("Testing if every image has at least one primary variant...")
 
-        problems = self.test_every_image_has_primary_variant()
+        started_at = time.monotonic()
+        problems, self_healed = self.test_every_image_has_primary_variant(dry_run)
+
         if problems:
             print(f"FAIL, the following images don't have any primary variants:")
             for problem in problems:
-                print(f"- {problem.id}")
+                print(f"- {problem}")
 
         else:
             print("OK")
+
+        add_to_report(
+            "has_primary_variant",
+            started_at,
+            problems=problems,
+            self_healed=self_healed,
+        )
+
+        if options["check_s3"]:
+            print("Testing if the bucket matches the available variants...")
+
+            started_at = time.monotonic()
+            missing_from_s3, not_in_database = self.test_s3_matches_variants()
+
+            if missing_from_s3 or not_in_database:
+                print(
+                    f"FAIL, {len(missing_from_s3)} variants are missing from S3, and {len(not_in_database)} files don't belong to any variant"
+                )
+            else:
+                print("OK")
+
+            add_to_report(
+                "s3_matches_variants",
+                started_at,
+                missing_from_s3=missing_from_s3,
+                not_in_database=not_in_database,
+            )
+
+        for check, results in report["checks"].items():
+            print(f"{check}: {results['duration']:.2f}s")
+
+        if options["report"]:
+            with open(options["report"], "w") as report_file:
+                json.dump(report, report_file, indent=2, default=str)
@@ -1,70 +1,417 @@
 import base64
 import json
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 import pika
 from django.core.management.base import BaseCommand
+from django.db import transaction
 import logging
 
+from images.cache import invalidate_variant_cache
+from images.formats import format_bucket, record_format_savings
 from images.models import ImageVariant
-from images.utils import get_b2_resource
+from images.utils import get_s3_client
 from kakigoori import settings
 
 import django
 
 logger = logging.getLogger(__name__)
 
+# Results that can't succeed however many times they are processed, e.g. a malformed message or a result file
+# already removed. They are acknowledged instead of requeued.
+PERMANENT_ERRORS = (KeyError, ValueError, FileNotFoundError)
+
+
+def get_result_variant(args):
+    # Runs in the consumer thread, so the upload threads never hold a database connection
+    variant_id = args["variant_id"]
+
+    logger.info("Processing variant {}".format(variant_id))
+
+    try:
+        variant = (
+            ImageVariant.objects.filter(id=variant_id)
+            .only(
+                "id",
+                "image_id",
+                "file_type",
+                "width",
+                "height",
+                "gaussian_blur",
+                "brightness",
+            )
+            .first()
+        )
+    except django.core.exceptions.ValidationError:
+        return None
+    if not variant:
+        logger.error("Variant not found")
+        return None
+
+    return variant
+
+
+def discard_failed_variant(args):
+    # The worker couldn't create the variant. It is deleted, so the variant it was encoded from is served instead of
+    # waiting for it forever.
+    logger.error(
+        "The worker failed to create variant {}: {}".format(
+            args["variant_id"], args["error"]
+        )
+    )
+
+    try:
+        ImageVariant.objects.filter(id=args["variant_id"], available=False).delete()
+    except django.core.exceptions.ValidationError:
+        pass
+
+
+def store_variant_result(variant, args):
+    # Runs in the upload threads: uploads the variant if the worker didn't, and returns it without saving it, as
+    # the variants are marked as available in batches, along with the time the worker spent encoding it and the
+    # shared storage file to remove once the batch is committed.
+    if variant.file_type == "avif":
+        content_type = "image/avif"
+    elif variant.file_type == "webp":
+        content_type = "image/webp"
+    else:
+        content_type = "binary/octet-stream"
+
+    result_path = None
+
+    if args.get("version", 1) == 1:
+        variant_file = base64.b64decode(args["variant_file"])
+        variant.file_size = len(variant_file)
+
+        get_s3_client().upload_fileobj(
+            BytesIO(variant_file),
+            settings.S3_BUCKET,
+            variant.s3_filepath,
+            ExtraArgs={"ContentType": content_type},
+        )
+    else:
+        variant.file_size = args["size"]
+
+        if "path" in args["destination"]:
+            # The worker wrote the result to the shared storage, it still has to be uploaded
+            result_path = args["destination"]["path"]
+            with open(result_path, "rb") as variant_file:
+                get_s3_client().upload_fileobj(
+                    variant_file,
+                    settings.S3_BUCKET,
+                    variant.s3_filepath,
+                    ExtraArgs={"ContentType": content_type},
+                )
+
+    variant.available = True
+
+    return variant, args.get("encode_seconds"), result_path
+
+
+def record_variant_savings(results):
+    # The savings are measured against the jpg or png variant the optimized variants were encoded from
+    sources = {}
+    for source in ImageVariant.objects.filter(
+        image_id__in={variant.image_id for variant, _, _ in results},
+        file_type__in=["jpg", "png"],
+        file_size__isnull=False,
+    ).only(
+        "image_id",
+        "width",
+        "height",
+        "gaussian_blur",
+        "brightness",
+        "file_type",
+        "file_size",
+    ):
+        sources[
+            (
+                source.image_id,
+                source.width,
+                source.height,
+                source.gaussian_blur,
+                source.brightness,
+            )
+        ] = source
+
+    savings = []
+    for variant, encode_seconds, _ in results:
+        source = sources.get(
+            (
+                variant.image_id,
+                variant.width,
+                variant.height,
+                variant.gaussian_blur,
+                variant.brightness,
+            )
+        )
+        if source is None:
+            continue
+
+        savings.append(
+            (
+                format_bucket(
+                    variant.file_type,
+                    variant.width,
+                    variant.height,
+                    variant.gaussian_blur,
+                    source.file_type,
+                ),
+                source.file_size,
+                variant.file_size,
+                encode_seconds,
+            )
+        )
+
+    record_format_savings(savings)
+
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency", type=int, default=settings.WORKER_RESULTS_CONCURRENCY
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=settings.WORKER_RESULTS_BATCH_SIZE
+        )
+        # Messages stay unacknowledged until their batch is committed, so the prefetch has to cover a whole batch on
+        # top of the messages in progress
+        parser.add_argument("--prefetch", type=int)
+        parser.add_argument(
+            "--batch-interval",
+            type=float,
+            default=settings.WORKER_RESULTS_BATCH_INTERVAL,
+        )
+        parser.add_argument(
+            "--retry-delay",
+            type=float,
+            default=settings.WORKER_RESULTS_RETRY_DELAY,
+        )
+
     def handle(self, *args, **options):
+        concurrency = options["concurrency"]
+        batch_size = options["batch_size"]
+        batch_interval = options["batch_interval"]
+        retry_delay = options["retry_delay"]
+        prefetch = options["prefetch"] or batch_size + 2 * concurrency
+
         connection = pika.BlockingConnection(settings.RABBITMQ_CONNECTION_PARAMETERS)
 
         channel = connection.channel()
         channel.queue_declare(queue="process_variant", durable=True)
 
-        def callback(ch, method, properties, body):
-            args = json.loads(body.decode("utf-8"))
+        executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="worker-results"
+        )
+
+        # pika channels can't be used from other threads, so the uploads run in the executor and everything
+        # touching RabbitMQ or the database stays in this thread
+        in_progress = []
+        completed = []
+        batch_started_at = None
+        # Messages that failed for a reason that may go away, e.g. S3 being unavailable, are held for the retry
+        # delay before being requeued, so they don't come straight back
+        retrying = []
 
-            variant_file = base64.b64decode(args["variant_file"])
-            variant_id = args["variant_id"]
+        processed = 0
+        failed = 0
+        started_at = time.monotonic()
+        last_report_at = started_at
+        stopping = False
 
-            logger.info("Processing variant {}".format(variant_id))
+        def callback(ch, method, properties, body):
+            nonlocal batch_started_at, failed
 
             try:
-                variant = ImageVariant.objects.filter(id=variant_id).first()
-            except django.core.exceptions.ValidationError:
+                args = json.loads(body.decode("utf-8"))
+
+                if "error" in args:
+                    discard_failed_variant(args)
+                    ch.basic_ack(delivery_tag=method.delivery_tag)
+                    failed += 1
+                    return
+
+                variant = get_result_variant(args)
+            except PERMANENT_ERRORS:
+                logger.exception("Discarding a malformed result")
                 ch.basic_ack(delivery_tag=method.delivery_tag)
+                failed += 1
                 return
-            if not variant:
-                logger.error("Variant not found")
-                ch.basic_ack(delivery_tag=method.delivery_tag)
+
+            if variant is None:
+                completed.append((method.delivery_tag, None))
+                if batch_started_at is None:
+                    batch_started_at = time.monotonic()
                 return
 
-            if variant.file_type == "avif":
-                content_type = "image/avif"
-            elif variant.file_type == "webp":
-                content_type = "image/webp"
-            else:
-                content_type = "binary/octet-stream"
+            in_progress.append(
+                (
+                    method.delivery_tag,
+                    executor.submit(store_variant_result, variant, args),
+                )
+            )
+
+        def collect_completed():
+            nonlocal in_progress, batch_started_at, failed
+
+            still_in_progress = []
+            for delivery_tag, future in in_progress:
+                if not future.done():
+                    still_in_progress.append((delivery_tag, future))
+                    continue
+
+                try:
+                    completed.append((delivery_tag, future.result()))
+                except PERMANENT_ERRORS:
+                    logger.exception("Failed to process a variant, discarding it")
+                    channel.basic_ack(delivery_tag=delivery_tag)
+                    failed += 1
+                    continue
+                except Exception:
+                    logger.exception("Failed to process a variant, retrying it")
+                    retrying.append((time.monotonic() + retry_delay, delivery_tag))
+                    failed += 1
+                    continue
+
+                if batch_started_at is None:
+                    batch_started_at = time.monotonic()
+
+            in_progress = still_in_progress
+
+        def flush():
+            nonlocal completed, batch_started_at, processed
+
+            if not completed:
+                return
+
+            results = [result for _, result in completed if result is not None]
+            variants = [variant for variant, _, _ in results]
+
+            # The messages are only acknowledged once the variants are committed, so a crash between the two only
+            # means the results get processed again
+            with transaction.atomic():
+                # Redelivered results are stored again, but only the variants becoming available count in the
+                # format savings
+                newly_available = set(
+                    ImageVariant.objects.select_for_update()
+                    .filter(
+                        id__in=[variant.id for variant in variants], available=False
+                    )
+                    .values_list("id", flat=True)
+                )
+                ImageVariant.objects.bulk_update(variants, ["available", "file_size"])
 
-            bucket = get_b2_resource()
+            for variant in variants:
+                invalidate_variant_cache(
+                    variant.image_id,
+                    variant.width,
+                    variant.height,
+                    variant.gaussian_blur,
+                    variant.brightness,
+                )
 
-            bucket.upload_fileobj(
-                BytesIO(variant_file),
-                variant.s3_filepath,
-                ExtraArgs={"ContentType": content_type},
+            for delivery_tag, _ in completed:
+                channel.basic_ack(delivery_tag=delivery_tag)
+
+            # Only removed once nothing can deliver the results again
+            for _, _, result_path in results:
+                if result_path is not None:
+                    try:
+                        os.remove(result_path)
+                    except FileNotFoundError:
+                        pass
+
+            new_results = [
+                result for result in results if result[0].id in newly_available
+            ]
+            if new_results:
+                try:
+                    record_variant_savings(new_results)
+                except Exception:
+                    # The results are already acknowledged, the savings are only statistics
+                    logger.exception("Failed to record the format savings")
+
+            logger.info("Processed {} variants".format(len(completed)))
+
+            processed += len(completed)
+            completed = []
+            batch_started_at = None
+
+        def requeue_retrying(force=False):
+            nonlocal retrying
+
+            now = time.monotonic()
+            still_retrying = []
+            for retry_at, delivery_tag in retrying:
+                if force or retry_at <= now:
+                    channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+                else:
+                    still_retrying.append((retry_at, delivery_tag))
+
+            retrying = still_retrying
+
+        def report():
+            nonlocal last_report_at
+
+            now = time.monotonic()
+            logger.info(
+                "Processed {} messages ({} failed), {:.1f} messages/s".format(
+                    processed, failed, processed / (now - started_at)
+                )
             )
+            last_report_at = now
+
+        def stop(signum, frame):
+            nonlocal stopping
+            logger.info("Stopping after the messages in progress")
+            stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        channel.basic_qos(prefetch_count=prefetch)
+        consumer_tag = channel.basic_consume(
+            queue="process_variant", on_message_callback=callback
+        )
+
+        logger.info(
+            "Ready to process, with {} threads and batches of {}".format(
+                concurrency, batch_size
+            )
+        )
+
+        while not stopping:
+            connection.process_data_events(time_limit=min(batch_interval, 0.1))
+            collect_completed()
+            requeue_retrying()
 
-            variant.available = True
-            variant.save()
+            if len(completed) >= batch_size or (
+                batch_started_at is not None
+                and time.monotonic() - batch_started_at >= batch_interval
+            ):
+                flush()
 
-            logger.info("Processed variant {}".format(variant_id))
+            if (
+                time.monotonic() - last_report_at
+                >= settings.WORKER_RESULTS_REPORT_INTERVAL
+            ):
+                report()
 
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+        # Messages received but not delivered to the callback yet are requeued by the cancel, the ones in progress
+        # are finished and acknowledged before closing
+        channel.basic_cancel(consumer_tag)
 
-        channel.basic_qos(prefetch_count=1)
-        channel.basic_consume(queue="process_variant", on_message_callback=callback)
+        while in_progress:
+            connection.process_data_events(time_limit=0.1)
+            collect_completed()
 
-        logger.info("Ready to process")
+        executor.shutdown()
+        flush()
+        requeue_retrying(force=True)
+        report()
 
-        channel.start_consuming()
+        connection.close()
@@ -0,0 +1,113 @@
+from uuid import UUID
+
+from django.conf import settings
+
+from images.cache import (
+    get_cached_image_size,
+    invalidate_image_cache,
+    set_cached_image_size,
+)
+from images.models import Image, thumbnail_size
+from images.utils import LRUCache, run_blocking
+
+
+class ImageRecord:
+    # What the serving views need to know about an image. Images don't change after their upload, so these records
+    # are cached in memory, and in Valkey to share them between processes.
+    __slots__ = ("id", "width", "height")
+
+    def __init__(self, id: UUID, width: int, height: int):
+        self.id = id
+        self.width = width
+        self.height = height
+
+    @property
+    def thumbnail_size(self):
+        return thumbnail_size(self.width, self.height)
+
+    def get_image(self) -> Image:
+        return Image.objects.get(id=self.id)
+
+    # Only needed when the requested variant doesn't exist yet, so the full image is loaded then
+
+    def closest_larger_variant(
+        self, width, height, gaussian_blur, brightness, file_types
+    ):
+        return self.get_image().closest_larger_variant(
+            width, height, gaussian_blur, brightness, file_types
+        )
+
+    def create_variant(self, width, height, gaussian_blur, brightness):
+        return self.get_image().create_variant(width, height, gaussian_blur, brightness)
+
+
+image_records = LRUCache(max_size=settings.IMAGE_CACHE_SIZE)
+
+
+def cache_image_record(record: ImageRecord, from_valkey: bool = False):
+    image_records.set(record.id, record, ttl=settings.IMAGE_CACHE_LOCAL_TTL)
+
+    if not from_valkey:
+        set_cached_image_size(record.id, record.width, record.height)
+
+
+def get_image_record_from_cache(image_id: UUID) -> ImageRecord | None:
+    found, record = image_records.get(image_id)
+    if found:
+        return record
+
+    size = get_cached_image_size(image_id)
+    if size is None:
+        return None
+
+    record = ImageRecord(image_id, *size)
+    cache_image_record(record, from_valkey=True)
+
+    return record
+
+
+def get_image_record(image_id: UUID) -> ImageRecord | None:
+    record = get_image_record_from_cache(image_id)
+    if record is not None:
+        return record
+
+    size = Image.objects.filter(id=image_id).values_list("width", "height").first()
+    if size is None:
+        return None
+
+    record = ImageRecord(image_id, *size)
+    cache_image_record(record)
+
+    return record
+
+
+async def get_image_record_async(image_id: UUID) -> ImageRecord | None:
+    found, record = image_records.get(image_id)
+    if found:
+        return record
+
+    record = await run_blocking(get_image_record_from_cache, image_id)
+    if record is not None:
+        return record
+
+    size = (
+        await Image.objects.filter(id=image_id).values_list("width", "height").afirst()
+    )
+    if size is None:
+        return None
+
+    record = ImageRecord(image_id, *size)
+    await run_blocking(cache_image_record, record)
+
+    return record
+
+
+def invalidate_local_image_record(image_id: UUID):
+    image_records.invalidate(image_id)
+
+
+def invalidate_image_record(image_id: UUID):
+    # Other processes keep their local record until it expires, their views answer with a 404 once the image is
+    # needed and can't be found
+    invalidate_local_image_record(image_id)
+    invalidate_image_cache(image_id)
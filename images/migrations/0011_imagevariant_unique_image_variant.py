@@ -0,0 +1,47 @@
+# Generated by Django 6.0.4 on 2026-10-18 19:52
+
+from django.db import migrations, models
+
+# Rows are removed with raw SQL so that the post_delete receiver, which relies on ImageVariant.s3_filepath, isn't
+# called with historical models. When duplicates exist, the primary and available variants are kept.
+REMOVE_DUPLICATE_VARIANTS = """
+DELETE FROM images_imagevariant
+WHERE id IN (
+    SELECT id
+    FROM (
+        SELECT
+            id,
+            ROW_NUMBER() OVER (
+                PARTITION BY image_id, height, width, gaussian_blur, brightness, file_type
+                ORDER BY is_primary_variant DESC, available DESC, id
+            ) AS position
+        FROM images_imagevariant
+    ) AS variants
+    WHERE position > 1
+)
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0010_remove_image_is_avif_available_and_more"),
+    ]
+
+    operations = [
+        migrations.RunSQL(REMOVE_DUPLICATE_VARIANTS, migrations.RunSQL.noop),
+        migrations.AddConstraint(
+            model_name="imagevariant",
+            constraint=models.UniqueConstraint(
+                fields=(
+                    "image",
+                    "height",
+                    "width",
+                    "gaussian_blur",
+                    "brightness",
+                    "file_type",
+                ),
+                name="unique_image_variant",
+            ),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 6.0.4 on 2026-10-18 19:54
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The indexes are built concurrently, so that the variants table isn't locked while they are created
+    atomic = False
+
+    dependencies = [
+        ("images", "0011_imagevariant_unique_image_variant"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="image",
+            index=models.Index(fields=["original_md5"], name="image_original_md5_idx"),
+        ),
+        AddIndexConcurrently(
+            model_name="imagevariant",
+            index=models.Index(
+                condition=models.Q(("available", True)),
+                fields=["image", "height", "width", "gaussian_blur", "brightness"],
+                include=("file_type", "id"),
+                name="imagevariant_available_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="imagevariant",
+            index=models.Index(
+                condition=models.Q(("is_primary_variant", True)),
+                fields=["image"],
+                name="imagevariant_primary_idx",
+            ),
+        ),
+    ]
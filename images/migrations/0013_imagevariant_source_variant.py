@@ -0,0 +1,25 @@
+# Generated by Django 6.0.4 on 2026-10-18 20:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0012_imagevariant_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagevariant",
+            name="source_variant",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="derived_variants",
+                to="images.imagevariant",
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.4 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0013_imagevariant_source_variant"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagevariant",
+            name="file_size",
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0.4 on 2026-10-18 23:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0014_imagevariant_file_size"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagevariant",
+            name="creation_date",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
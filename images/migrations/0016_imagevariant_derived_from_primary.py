@@ -0,0 +1,28 @@
+# Generated by Django 6.0.4 on 2026-10-18 23:40
+
+from django.db import migrations, models
+
+
+def set_derived_from_primary(apps, schema_editor):
+    ImageVariant = apps.get_model("images", "ImageVariant")
+
+    ImageVariant.objects.filter(
+        source_variant__isnull=False,
+        source_variant__is_primary_variant=False,
+    ).update(derived_from_primary=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0015_imagevariant_creation_date"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagevariant",
+            name="derived_from_primary",
+            field=models.BooleanField(default=True),
+        ),
+        migrations.RunPython(set_derived_from_primary, migrations.RunPython.noop),
+    ]
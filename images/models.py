@@ -1,12 +1,31 @@
+import hashlib
 import uuid
 from io import BytesIO
 
-from django.db import models
+import psycopg
+from django.conf import settings
+from django.db import connection, models, transaction, OperationalError
 from django.utils import timezone
 
-from images.tasks import send_image_to_worker
-from images.utils import get_b2_resource
-from PIL import Image as PILImage, ImageOps, ImageEnhance, ImageFilter
+from images.formats import optimized_file_types
+from images.originals_cache import open_original
+from images.processing import resize_image
+from images.tasks import INTERACTIVE, send_images_to_worker
+from images.utils import get_s3_client
+
+
+class VariantCreationTimeout(Exception):
+    pass
+
+
+THUMBNAIL_SIZE = 600
+
+
+def thumbnail_size(width, height, size=THUMBNAIL_SIZE):
+    if height > width:
+        return int(size * width / height), size
+    else:
+        return size, int(size * height / width)
 
 
 class Image(models.Model):
@@ -20,58 +39,92 @@ class Image(models.Model):
     width = models.IntegerField(default=0)
     version = models.IntegerField(default=2)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["original_md5"], name="image_original_md5_idx"),
+        ]
+
     @property
     def thumbnail_size(self):
-        if self.height > self.width:
-            return int(600 * self.width / self.height), 600
-        else:
-            return 600, int(600 * self.height / self.width)
+        return thumbnail_size(self.width, self.height)
 
     @property
     def backblaze_filepath(self):
         return f"{self.id.hex[:2]}/{self.id.hex[2:4]}/{self.id.hex}"
 
-    def create_variant_tasks(self, variant, image_data: BytesIO):
-        avif_variant = ImageVariant(
-            image=variant.image,
-            height=variant.height,
-            width=variant.width,
-            is_full_size=variant.is_full_size,
-            file_type="avif",
-            gaussian_blur=variant.gaussian_blur,
-            brightness=variant.brightness,
-            available=False,
-        )
+    def create_variant_tasks(self, variant, image_data: BytesIO, job_class=INTERACTIVE):
+        optimized_variants = []
+
+        for file_type in optimized_file_types(variant):
+            optimized_variant, created = ImageVariant.objects.get_or_create(
+                image=variant.image,
+                height=variant.height,
+                width=variant.width,
+                gaussian_blur=variant.gaussian_blur,
+                brightness=variant.brightness,
+                file_type=file_type,
+                defaults={
+                    "is_full_size": variant.is_full_size,
+                    "available": False,
+                },
+            )
+
+            if created:
+                optimized_variants.append(optimized_variant)
 
-        avif_variant.save()
-
-        webp_variant = ImageVariant(
-            image=variant.image,
-            height=variant.height,
-            width=variant.width,
-            is_full_size=variant.is_full_size,
-            file_type="webp",
-            gaussian_blur=variant.gaussian_blur,
-            brightness=variant.brightness,
-            available=False,
+        # The worker can answer before the surrounding transaction commits, so the variants have to exist in the
+        # database before the tasks are sent.
+        transaction.on_commit(
+            lambda: send_images_to_worker(
+                image_variants=optimized_variants,
+                image_data=image_data,
+                job_class=job_class,
+            )
         )
-        webp_variant.save()
 
-        send_image_to_worker(image_variant=avif_variant, image_data=image_data)
-        send_image_to_worker(image_variant=webp_variant, image_data=image_data)
+    def download_variant(self, variant):
+        if settings.ORIGINALS_CACHE_PATH:
+            return open_original(variant)
 
-    def download_original_variant(self):
-        bucket = get_b2_resource()
+        image_data = BytesIO()
 
-        original_image = BytesIO()
+        get_s3_client().download_fileobj(
+            settings.S3_BUCKET,
+            variant.s3_filepath,
+            image_data,
+        )
+        image_data.seek(0)
+        return image_data
+
+    def download_original_variant(self):
         original_variant = self.imagevariant_set.filter(is_primary_variant=True).first()
 
-        bucket.download_fileobj(
-            original_variant.s3_filepath,
-            original_image,
+        return self.download_variant(original_variant)
+
+    def source_variant_for(self, width, height, gaussian_blur, brightness):
+        # Resizing an existing variant is cheaper than resizing the original. To limit the quality loss, the source
+        # has to be sufficiently larger than the target, and must itself have been created from the primary variant.
+        source_variant = (
+            self.imagevariant_set.filter(
+                derived_from_primary=True,
+                width__gte=width * settings.VARIANT_SOURCE_MIN_SCALE,
+                height__gte=height * settings.VARIANT_SOURCE_MIN_SCALE,
+                gaussian_blur=gaussian_blur,
+                brightness=brightness,
+                available=True,
+                is_primary_variant=False,
+                file_type__in=["jpg", "png"],
+            )
+            .order_by("width", "height")
+            .first()
         )
-        original_image.seek(0)
-        return original_image
+
+        if source_variant is None:
+            source_variant = self.imagevariant_set.filter(
+                is_primary_variant=True
+            ).first()
+
+        return source_variant
 
     def create_resized_image(
         self,
@@ -79,38 +132,108 @@ class Image(models.Model):
         width,
         gaussian_blur,
         brightness,
+        source_variant=None,
+    ):
+        if source_variant is None or source_variant.is_primary_variant:
+            source_image = self.download_original_variant()
+        else:
+            source_image = self.download_variant(source_variant)
+            # The source already has the same blur and brightness
+            gaussian_blur = 0
+            brightness = 1
+
+        resized_image, file_extension = resize_image(
+            source_image,
+            width,
+            height,
+            gaussian_blur,
+            brightness,
+            resize_first=settings.RESIZE_BEFORE_FILTERS,
+        )
+
+        source_image.close()
+
+        return resized_image, file_extension
+
+    def closest_larger_variant(
+        self, width, height, gaussian_blur, brightness, file_types
     ):
-        original_image = self.download_original_variant()
-        resized_image = BytesIO()
-        file_extension = "jpg"
-
-        with PILImage.open(original_image) as im:
-            ImageOps.exif_transpose(im, in_place=True)
-            im = im.filter(ImageFilter.GaussianBlur(gaussian_blur))
-            enhancer = ImageEnhance.Brightness(im)
-            im = enhancer.enhance(brightness)
-            im.thumbnail(
-                (width, height), resample=PILImage.Resampling.LANCZOS, reducing_gap=3.0
+        variant = (
+            self.imagevariant_set.filter(
+                width__gte=width,
+                height__gte=height,
+                gaussian_blur=gaussian_blur,
+                brightness=brightness,
+                available=True,
+                file_type__in=file_types,
             )
+            .order_by("width", "height")
+            .first()
+        )
 
-            if im.has_transparency_data:
-                try:
-                    im.save(resized_image, "PNG", quality=90)
-                    file_extension = "png"
-                except OSError:
-                    im.convert("RGB").save(resized_image, "JPEG", quality=90)
-            else:
-                try:
-                    im.save(resized_image, "JPEG", quality=90)
-                except OSError:
-                    im.convert("RGB").save(resized_image, "JPEG", quality=90)
+        if variant is None:
+            variant = self.imagevariant_set.filter(is_primary_variant=True).first()
 
-        resized_image.seek(0)
+        return variant
 
-        return resized_image, file_extension
+    def variant_creation_lock_id(self, width, height, gaussian_blur, brightness):
+        key = (
+            f"{self.id.hex}:{width}:{height}:{float(gaussian_blur)}:{float(brightness)}"
+        )
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big", signed=True)
 
-    def create_variant(self, width, height, gaussian_blur, brightness):
-        bucket = get_b2_resource()
+    def create_variant(
+        self, width, height, gaussian_blur, brightness, job_class=INTERACTIVE
+    ):
+        # Only one process creates a given variant at a time, the others wait for the lock and then pick up the
+        # variant it created. The lock is held by the session rather than a transaction, so that the download, the
+        # resize and the upload don't keep a transaction open.
+        lock_id = self.variant_creation_lock_id(
+            width, height, gaussian_blur, brightness
+        )
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT set_config('lock_timeout', %s, false)",
+                [f"{int(settings.VARIANT_CREATION_LOCK_TIMEOUT * 1000)}ms"],
+            )
+            try:
+                cursor.execute("SELECT pg_advisory_lock(%s)", [lock_id])
+            except OperationalError as e:
+                if isinstance(e.__cause__, psycopg.errors.LockNotAvailable):
+                    raise VariantCreationTimeout() from e
+                raise
+            finally:
+                # The connection goes back to the pool, with the lock timeout of the other queries
+                cursor.execute("RESET lock_timeout")
+
+        try:
+            existing_variant = ImageVariant.objects.filter(
+                image=self,
+                height=height,
+                width=width,
+                gaussian_blur=gaussian_blur,
+                brightness=brightness,
+                file_type__in=["jpg", "png"],
+            ).first()
+
+            if existing_variant:
+                return existing_variant
+
+            return self._create_variant(
+                width, height, gaussian_blur, brightness, job_class
+            )
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [lock_id])
+
+    def _create_variant(
+        self, width, height, gaussian_blur, brightness, job_class=INTERACTIVE
+    ):
+        source_variant = self.source_variant_for(
+            width, height, gaussian_blur, brightness
+        )
 
         image_variant = ImageVariant(
             image=self,
@@ -121,10 +244,18 @@ class Image(models.Model):
             gaussian_blur=gaussian_blur,
             brightness=brightness,
             available=True,
+            source_variant=source_variant,
+            derived_from_primary=(
+                source_variant is None or source_variant.is_primary_variant
+            ),
         )
 
         resized_image, file_extension = self.create_resized_image(
-            height, width, gaussian_blur, brightness
+            height,
+            width,
+            gaussian_blur,
+            brightness,
+            source_variant=image_variant.source_variant,
         )
 
         if file_extension == "jpg":
@@ -139,18 +270,24 @@ class Image(models.Model):
         # We're making a copy here because we had errors that the next seek was failing because resized_image
         # was closed.
         s3_copy = BytesIO(resized_image.read())
+        image_variant.file_size = len(s3_copy.getbuffer())
 
-        bucket.upload_fileobj(
+        get_s3_client().upload_fileobj(
             s3_copy,
+            settings.S3_BUCKET,
             image_variant.s3_filepath,
             ExtraArgs={"ContentType": content_type},
         )
 
-        image_variant.save()
-
         resized_image.seek(0)
 
-        self.create_variant_tasks(image_variant, image_data=resized_image)
+        # The tasks are only sent once the variants they are for are committed
+        with transaction.atomic():
+            image_variant.save()
+
+            self.create_variant_tasks(
+                image_variant, image_data=resized_image, job_class=job_class
+            )
 
         return image_variant
 
@@ -166,6 +303,46 @@ class ImageVariant(models.Model):
     is_full_size = models.BooleanField(default=False)
     file_type = models.CharField(max_length=10)
     available = models.BooleanField(default=False)
+    file_size = models.PositiveBigIntegerField(null=True, blank=True)
+    creation_date = models.DateTimeField(default=timezone.now)
+    source_variant = models.ForeignKey(
+        "self",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="derived_variants",
+    )
+    # Kept apart from source_variant, which is cleared when the source is deleted
+    derived_from_primary = models.BooleanField(default=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=[
+                    "image",
+                    "height",
+                    "width",
+                    "gaussian_blur",
+                    "brightness",
+                    "file_type",
+                ],
+                name="unique_image_variant",
+            ),
+        ]
+        indexes = [
+            # Covers the lookup done for every request in image_with_size, so it can be answered from the index
+            models.Index(
+                fields=["image", "height", "width", "gaussian_blur", "brightness"],
+                include=["file_type", "id"],
+                condition=models.Q(available=True),
+                name="imagevariant_available_idx",
+            ),
+            models.Index(
+                fields=["image"],
+                condition=models.Q(is_primary_variant=True),
+                name="imagevariant_primary_idx",
+            ),
+        ]
 
     @property
     def s3_filepath(self):
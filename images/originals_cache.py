@@ -0,0 +1,207 @@
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+
+from images.cache import get_counters, increment_counters
+from images.utils import get_s3_client
+
+logger = logging.getLogger(__name__)
+
+ORIGINALS_CACHE_HITS_KEY = "kakigoori:originals_cache:hits"
+ORIGINALS_CACHE_MISSES_KEY = "kakigoori:originals_cache:misses"
+ORIGINALS_CACHE_BYTES_SAVED_KEY = "kakigoori:originals_cache:bytes_saved"
+
+# Evictions go below the maximum size, so that the next ones only come after a number of new files
+ORIGINALS_CACHE_EVICT_TO = 0.9
+
+# Size of the cache at the last scan of this process, plus what it downloaded since. Files downloaded by the other
+# processes are only seen by the next scan.
+_estimated_size = None
+_estimated_size_lock = threading.Lock()
+
+
+def cache_path(variant) -> str:
+    return os.path.join(
+        settings.ORIGINALS_CACHE_PATH, variant.id.hex[:2], variant.id.hex
+    )
+
+
+def remove_cached_file(path: str):
+    for file_path in [path, f"{path}.md5"]:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def open_mmap(path: str) -> mmap.mmap:
+    with open(path, "rb") as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_cached_file(path: str) -> mmap.mmap | None:
+    # The MD5 is checked when the file is downloaded, hits only check that the file still has the same size, so
+    # they don't have to read the whole file
+    try:
+        with open(f"{path}.md5") as file:
+            _, expected_size = file.read().split()
+        mapped_file = open_mmap(path)
+    except (FileNotFoundError, ValueError):
+        # ValueError is raised when trying to map an empty file, or for the files cached before their size was
+        # recorded, which are downloaded again
+        return None
+
+    if len(mapped_file) != int(expected_size):
+        logger.warning(f"Cached original {path} is corrupted, removing it")
+        mapped_file.close()
+        remove_cached_file(path)
+        return None
+
+    # The modification time is used to know which files were least recently used
+    os.utime(path)
+
+    return mapped_file
+
+
+def write_atomically(path: str, write):
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path), prefix=".tmp", delete=False
+    ) as temporary_file:
+        try:
+            write(temporary_file)
+        except BaseException:
+            os.remove(temporary_file.name)
+            raise
+
+    os.replace(temporary_file.name, path)
+
+
+def download_to_cache(variant, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    response = get_s3_client().get_object(
+        Bucket=settings.S3_BUCKET, Key=variant.s3_filepath
+    )
+
+    md5 = hashlib.md5()
+    size = 0
+
+    def write_body(file):
+        nonlocal size
+
+        for chunk in response["Body"].iter_chunks(1024 * 1024):
+            md5.update(chunk)
+            file.write(chunk)
+            size += len(chunk)
+
+        # The ETag is only the MD5 of the object for uploads that weren't multipart
+        e_tag = response["ETag"].strip('"')
+        if "-" not in e_tag and e_tag != md5.hexdigest():
+            raise IOError(f"Downloaded {variant.s3_filepath} doesn't match its ETag")
+
+    write_atomically(path, write_body)
+    write_atomically(
+        f"{path}.md5",
+        lambda file: file.write(f"{md5.hexdigest()} {size}".encode("utf-8")),
+    )
+
+    return size
+
+
+def evict():
+    global _estimated_size
+
+    entries = []
+    total_size = 0
+
+    for shard in os.scandir(settings.ORIGINALS_CACHE_PATH):
+        if not shard.is_dir():
+            continue
+
+        for entry in os.scandir(shard.path):
+            if entry.name.startswith(".tmp") or entry.name.endswith(".md5"):
+                continue
+
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+    if total_size > settings.ORIGINALS_CACHE_MAX_BYTES:
+        for _, size, path in sorted(entries):
+            remove_cached_file(path)
+            total_size -= size
+
+            if (
+                total_size
+                <= settings.ORIGINALS_CACHE_MAX_BYTES * ORIGINALS_CACHE_EVICT_TO
+            ):
+                break
+
+    _estimated_size = total_size
+
+
+def add_to_estimated_size(size: int) -> bool:
+    # Returns whether the cache may have gone over its maximum size, and has to be scanned
+    global _estimated_size
+
+    with _estimated_size_lock:
+        if _estimated_size is None:
+            return True
+
+        _estimated_size += size
+        return _estimated_size > settings.ORIGINALS_CACHE_MAX_BYTES
+
+
+def open_original(variant) -> mmap.mmap:
+    path = cache_path(variant)
+
+    mapped_file = read_cached_file(path)
+    if mapped_file is not None:
+        increment_counters(
+            {
+                ORIGINALS_CACHE_HITS_KEY: 1,
+                ORIGINALS_CACHE_BYTES_SAVED_KEY: len(mapped_file),
+            }
+        )
+        return mapped_file
+
+    increment_counters({ORIGINALS_CACHE_MISSES_KEY: 1})
+
+    size = download_to_cache(variant, path)
+
+    # Mapped before evicting, so that the file can still be read even if it gets evicted right away
+    mapped_file = open_mmap(path)
+    if add_to_estimated_size(size):
+        evict()
+
+    return mapped_file
+
+
+def get_originals_cache_stats() -> dict[str, int | float] | None:
+    counters = get_counters(
+        ORIGINALS_CACHE_HITS_KEY,
+        ORIGINALS_CACHE_MISSES_KEY,
+        ORIGINALS_CACHE_BYTES_SAVED_KEY,
+    )
+    if counters is None:
+        return None
+
+    hits, misses, bytes_saved = counters
+    lookups = hits + misses
+
+    return {
+        "lookups": lookups,
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / lookups if lookups else 0.0,
+        "bytes_saved": bytes_saved,
+    }
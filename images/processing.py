@@ -0,0 +1,83 @@
+from io import BytesIO
+
+from PIL import ExifTags, Image as PILImage, ImageOps, ImageEnhance, ImageFilter
+
+# EXIF orientations for which exif_transpose swaps the width and the height
+TRANSPOSED_ORIENTATIONS = [5, 6, 7, 8]
+
+REDUCING_GAP = 3.0
+
+
+def shrink_on_load(im: PILImage.Image, width: int, height: int):
+    # Lets the JPEG decoder do part of the downscaling in the DCT domain, decoding directly at 1/2, 1/4 or 1/8 of
+    # the size while staying at least REDUCING_GAP times larger than the target. The rest of the downscaling is done
+    # by thumbnail, with Image.reduce and then LANCZOS.
+    if im.getexif().get(ExifTags.Base.Orientation) in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+
+    im.draft(None, (int(width * REDUCING_GAP), int(height * REDUCING_GAP)))
+
+
+def apply_filters(im: PILImage.Image, gaussian_blur: float, brightness: float):
+    if gaussian_blur:
+        im = im.filter(ImageFilter.GaussianBlur(gaussian_blur))
+
+    if brightness != 1:
+        enhancer = ImageEnhance.Brightness(im)
+        im = enhancer.enhance(brightness)
+
+    return im
+
+
+def resize_image(
+    original_image,
+    width: int,
+    height: int,
+    gaussian_blur: float,
+    brightness: float,
+    fast_path: bool = True,
+    resize_first: bool = True,
+):
+    resized_image = BytesIO()
+    file_extension = "jpg"
+
+    with PILImage.open(original_image) as im:
+        original_size = max(im.size)
+
+        # When the blur is applied before resizing, its radius is relative to the original resolution, so the
+        # original has to be decoded at full size
+        if fast_path and (resize_first or not gaussian_blur):
+            shrink_on_load(im, width, height)
+
+        ImageOps.exif_transpose(im, in_place=True)
+
+        if not resize_first:
+            im = apply_filters(im, gaussian_blur, brightness)
+
+        im.thumbnail(
+            (width, height),
+            resample=PILImage.Resampling.LANCZOS,
+            reducing_gap=REDUCING_GAP,
+        )
+
+        if resize_first:
+            # gaussian_blur is expressed in pixels of the original, so it's scaled down to the new resolution
+            im = apply_filters(
+                im, gaussian_blur * max(im.size) / original_size, brightness
+            )
+
+        if im.has_transparency_data:
+            try:
+                im.save(resized_image, "PNG", quality=90)
+                file_extension = "png"
+            except OSError:
+                im.convert("RGB").save(resized_image, "JPEG", quality=90)
+        else:
+            try:
+                im.save(resized_image, "JPEG", quality=90)
+            except OSError:
+                im.convert("RGB").save(resized_image, "JPEG", quality=90)
+
+    resized_image.seek(0)
+
+    return resized_image, file_extension
@@ -0,0 +1,87 @@
+import botocore
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+
+from images.utils import get_s3_client, run_blocking
+
+
+def variant_key(url: str) -> str:
+    return url.removeprefix(f"{settings.S3_PUBLIC_BASE_PATH}/")
+
+
+def accel_redirect(key: str) -> HttpResponse:
+    # The proxy in front of Kakigoori fetches the object itself, and sets the content type from its response
+    response = HttpResponse()
+    response[settings.IMAGE_ACCEL_HEADER] = f"{settings.IMAGE_ACCEL_PREFIX}{key}"
+    del response["Content-Type"]
+
+    return response
+
+
+def get_variant_object(key: str, range_header: str | None):
+    parameters = {"Bucket": settings.S3_BUCKET, "Key": key}
+    # S3 answers ranges with a 206 and the Content-Range itself, so they are passed as is
+    if range_header:
+        parameters["Range"] = range_header
+
+    return get_s3_client().get_object(**parameters)
+
+
+def s3_error_response(error: botocore.exceptions.ClientError) -> HttpResponse:
+    code = error.response["Error"]["Code"]
+
+    if code in ["NoSuchKey", "404"]:
+        return JsonResponse({"error": "Image version not available"}, status=404)
+    if code == "InvalidRange":
+        return HttpResponse(status=416)
+
+    raise error
+
+
+def variant_object_response(s3_object, streaming_content) -> StreamingHttpResponse:
+    response = StreamingHttpResponse(
+        streaming_content,
+        status=206 if "ContentRange" in s3_object else 200,
+        content_type=s3_object.get("ContentType"),
+    )
+    response["Content-Length"] = s3_object["ContentLength"]
+    response["Accept-Ranges"] = "bytes"
+    if "ContentRange" in s3_object:
+        response["Content-Range"] = s3_object["ContentRange"]
+
+    return response
+
+
+def iter_object_body(body):
+    try:
+        yield from body.iter_chunks(settings.IMAGE_PROXY_CHUNK_SIZE)
+    finally:
+        body.close()
+
+
+async def aiter_object_body(body):
+    try:
+        while chunk := await run_blocking(body.read, settings.IMAGE_PROXY_CHUNK_SIZE):
+            yield chunk
+    finally:
+        body.close()
+
+
+def stream_variant(request, key: str) -> HttpResponse:
+    try:
+        s3_object = get_variant_object(key, request.headers.get("Range"))
+    except botocore.exceptions.ClientError as e:
+        return s3_error_response(e)
+
+    return variant_object_response(s3_object, iter_object_body(s3_object["Body"]))
+
+
+async def stream_variant_async(request, key: str) -> HttpResponse:
+    try:
+        s3_object = await run_blocking(
+            get_variant_object, key, request.headers.get("Range")
+        )
+    except botocore.exceptions.ClientError as e:
+        return s3_error_response(e)
+
+    return variant_object_response(s3_object, aiter_object_body(s3_object["Body"]))
@@ -0,0 +1,102 @@
+import bisect
+import functools
+import logging
+from uuid import UUID
+
+import valkey
+from django.conf import settings
+
+from images.cache import get_counters
+from images.utils import get_valkey_client
+
+logger = logging.getLogger(__name__)
+
+SIZE_LADDER_SNAPPED_KEY = "kakigoori:size_ladder:snapped"
+SIZE_LADDER_REQUESTED_SIZES_KEY = "kakigoori:size_ladder:requested_sizes"
+SIZE_LADDER_SERVED_SIZES_KEY = "kakigoori:size_ladder:served_sizes"
+
+# Larger than any image we would resize
+SIZE_LADDER_MAX = 16384
+
+
+def build_size_ladder(
+    breakpoints: list[int], step: float, minimum: int, maximum: int = SIZE_LADDER_MAX
+) -> list[int]:
+    rungs = set(breakpoints)
+
+    if step > 1:
+        size = minimum
+        while size < maximum:
+            rungs.add(size)
+            # Always move by at least one pixel, so small steps still end
+            size = max(size + 1, round(size * step))
+
+    return sorted(rungs)
+
+
+def snap_size(size: int, full_size: int, ladder: list[int]) -> int:
+    # The smallest rung at or above the requested size. Sizes above the last rung, and rungs at or above the size of
+    # the image, are served at full size.
+    if not ladder or size >= full_size:
+        return size
+
+    position = bisect.bisect_left(ladder, size)
+    if position == len(ladder):
+        return full_size
+
+    return min(ladder[position], full_size)
+
+
+@functools.cache
+def get_size_ladder() -> list[int]:
+    return build_size_ladder(
+        settings.SIZE_LADDER,
+        settings.SIZE_LADDER_STEP,
+        settings.SIZE_LADDER_MIN,
+    )
+
+
+def record_snapped_size(image_id: UUID, dimension: str, requested: int, served: int):
+    client = get_valkey_client()
+    if client is None:
+        return
+
+    try:
+        # HyperLogLogs, so counting the distinct sizes stays cheap however many of them are requested
+        pipeline = client.pipeline(transaction=False)
+        pipeline.incr(SIZE_LADDER_SNAPPED_KEY)
+        pipeline.pfadd(
+            SIZE_LADDER_REQUESTED_SIZES_KEY, f"{image_id.hex}:{dimension}:{requested}"
+        )
+        pipeline.pfadd(
+            SIZE_LADDER_SERVED_SIZES_KEY, f"{image_id.hex}:{dimension}:{served}"
+        )
+        pipeline.execute()
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to update the size ladder counters")
+
+
+def get_size_ladder_stats() -> dict[str, int] | None:
+    client = get_valkey_client()
+    if client is None:
+        return None
+
+    counters = get_counters(SIZE_LADDER_SNAPPED_KEY)
+    if counters is None:
+        return None
+
+    (snapped,) = counters
+
+    try:
+        requested_sizes = client.pfcount(SIZE_LADDER_REQUESTED_SIZES_KEY)
+        served_sizes = client.pfcount(SIZE_LADDER_SERVED_SIZES_KEY)
+    except valkey.exceptions.ValkeyError:
+        logger.exception("Failed to read the size ladder counters")
+        return None
+
+    return {
+        "snapped": snapped,
+        "requested_sizes": requested_sizes,
+        "served_sizes": served_sizes,
+        "collapsed_sizes": max(requested_sizes - served_sizes, 0),
+    }
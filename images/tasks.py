@@ -1,48 +1,263 @@
 import base64
+import copy
 import json
+import logging
+import os
+import shutil
+import threading
+import uuid
 from io import BytesIO
 
 import pika
 
-from images.utils import get_b2_resource
+from images.utils import get_s3_client
 from kakigoori import settings
 
+logger = logging.getLogger(__name__)
 
-def send_image_to_worker(image_variant, image_data: BytesIO | None = None):
-    original_image_variant = image_variant.parent_variant_for_optimized_versions
+# Job classes of the worker tasks, from the most to the least urgent. The worker always takes the tasks of a class
+# before the ones of the next classes.
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+BULK = "bulk"
+JOB_CLASSES = [INTERACTIVE, BACKGROUND, BULK]
+
+
+class Publisher:
+    # One connection per process, reused for every publish. The channel is in confirm mode, so a publish only
+    # returns once the broker has taken responsibility for the message. pika's blocking channels wait for each
+    # confirmation in turn, so a batch costs one round trip per message.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._connection = None
+        self._channel = None
+        self._declared_queues = set()
+
+    def _reset(self):
+        if self._connection is not None and self._pid == os.getpid():
+            try:
+                self._connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+
+        self._pid = None
+        self._connection = None
+        self._channel = None
+        self._declared_queues = set()
+
+    def _get_channel(self):
+        # A connection inherited through a fork (e.g. gunicorn workers) is shared with the parent and can't be used
+        if self._pid != os.getpid():
+            self._reset()
+
+        if self._connection is not None and self._connection.is_open:
+            # A blocking connection only answers heartbeats while it is being used, so the ones received since the
+            # last publish are handled first. A connection the broker closed in the meantime raises here, and is
+            # opened again by the retry.
+            self._connection.process_data_events(0)
+
+        if self._connection is None or self._connection.is_closed:
+            self._reset()
+            # Heartbeats stay enabled to notice half-open connections while waiting for a confirmation, and a
+            # broker blocking publishers makes the publish fail instead of hanging the request
+            parameters = copy.copy(settings.RABBITMQ_CONNECTION_PARAMETERS)
+            parameters.socket_timeout = settings.RABBITMQ_PUBLISH_TIMEOUT
+            parameters.blocked_connection_timeout = settings.RABBITMQ_PUBLISH_TIMEOUT
+
+            self._connection = pika.BlockingConnection(parameters)
+            self._channel = self._connection.channel()
+            self._channel.confirm_delivery()
+            self._pid = os.getpid()
+
+        return self._channel
+
+    def publish_batch(self, messages: list[tuple[str, bytes]]):
+        if not messages:
+            return
+
+        with self._lock:
+            # Number of messages already confirmed by the broker, which aren't published again by the retry
+            published = 0
+
+            for attempt in range(2):
+                try:
+                    channel = self._get_channel()
+
+                    for queue, body in messages[published:]:
+                        if queue not in self._declared_queues:
+                            channel.queue_declare(queue=queue, durable=True)
+                            self._declared_queues.add(queue)
+
+                        channel.basic_publish(
+                            exchange="",
+                            routing_key=queue,
+                            body=body,
+                            properties=pika.BasicProperties(
+                                delivery_mode=pika.DeliveryMode.Persistent
+                            ),
+                        )
+                        published += 1
+
+                    return
+                except pika.exceptions.AMQPError:
+                    # The connection can still be lost, e.g. when the broker restarts, reconnect and retry once
+                    self._reset()
+                    if attempt > 0:
+                        raise
+                    logger.warning("Lost connection to RabbitMQ, reconnecting")
+
+    def publish(self, queue: str, body: bytes):
+        self.publish_batch([(queue, body)])
+
+
+publisher = Publisher()
+
+
+def job_class_queue(queue, job_class):
+    # Interactive jobs keep the queue used before job classes existed
+    if job_class == INTERACTIVE or not settings.WORKER_JOB_CLASS_QUEUES:
+        return queue
+
+    return f"{queue}_{job_class}"
+
+
+def worker_queue(file_type, job_class=INTERACTIVE):
+    if file_type not in ["avif", "webp"]:
+        return None
+
+    if settings.WORKER_TASK_PROTOCOL == 2 and settings.WORKER_COMBINED_QUEUE:
+        return job_class_queue("kakigoori_all", job_class)
+
+    return job_class_queue(f"kakigoori_{file_type}", job_class)
+
+
+def worker_message(
+    image_variant, image_data: BytesIO | None = None, job_class=INTERACTIVE
+):
+    queue = worker_queue(image_variant.file_type, job_class)
+    if queue is None:
+        return None
 
     if image_data:
         file = image_data
     else:
-        s3_bucket = get_b2_resource()
+        original_image_variant = image_variant.parent_variant_for_optimized_versions
 
         file = BytesIO()
-        s3_bucket.download_fileobj(original_image_variant.s3_filepath, file)
+        get_s3_client().download_fileobj(
+            settings.S3_BUCKET, original_image_variant.s3_filepath, file
+        )
 
     file.seek(0)
 
     message = {
         "variant_id": str(image_variant.id),
-        "original_file": base64.b64encode(file.getbuffer()).decode("utf-8"),
+        "original_file": base64.b64encode(file.read()).decode("utf-8"),
     }
 
-    connection = pika.BlockingConnection(settings.RABBITMQ_CONNECTION_PARAMETERS)
-    channel = connection.channel()
+    return queue, json.dumps(message).encode("utf-8")
+
+
+def write_to_shared_storage(source_variant, image_data: BytesIO | None = None):
+    # Every message gets its own copy of the source, as the worker removes it once the message has been processed
+    path = os.path.join(
+        settings.WORKER_SHARED_STORAGE_PATH, f"{uuid.uuid4().hex}_source"
+    )
+
+    with open(path, "wb") as file:
+        if image_data:
+            image_data.seek(0)
+            shutil.copyfileobj(image_data, file)
+        else:
+            get_s3_client().download_fileobj(
+                settings.S3_BUCKET, source_variant.s3_filepath, file
+            )
+
+    return path
+
+
+def worker_messages_v2(
+    image_variants, image_data: BytesIO | None = None, job_class=INTERACTIVE
+):
+    # Version 2 of the protocol only passes the location of the files, the worker reads the source and writes the
+    # results itself.
+    variants_by_queue = {}
+    for variant in image_variants:
+        queue = worker_queue(variant.file_type, job_class)
+        if queue:
+            variants_by_queue.setdefault(queue, []).append(variant)
+
+    if not variants_by_queue:
+        return []
+
+    source_variant = image_variants[0].parent_variant_for_optimized_versions
+
+    messages = []
+    for queue, variants in variants_by_queue.items():
+        if settings.WORKER_SHARED_STORAGE_PATH:
+            source = {"path": write_to_shared_storage(source_variant, image_data)}
+        else:
+            source = {"s3_key": source_variant.s3_filepath}
 
-    if image_variant.file_type == "avif":
-        queue = "kakigoori_avif"
-    elif image_variant.file_type == "webp":
-        queue = "kakigoori_webp"
+        outputs = []
+        for variant in variants:
+            if settings.WORKER_SHARED_STORAGE_PATH:
+                destination = {
+                    "path": os.path.join(
+                        settings.WORKER_SHARED_STORAGE_PATH,
+                        f"{variant.id.hex}.{variant.file_type}",
+                    )
+                }
+            else:
+                destination = {"s3_key": variant.s3_filepath}
+
+            outputs.append(
+                {
+                    "variant_id": str(variant.id),
+                    "file_type": variant.file_type,
+                    "destination": destination,
+                }
+            )
+
+        message = {
+            "version": 2,
+            "source": source,
+            "outputs": outputs,
+        }
+
+        messages.append((queue, json.dumps(message).encode("utf-8")))
+
+    return messages
+
+
+def send_images_to_worker(
+    image_variants, image_data: BytesIO | None = None, job_class=INTERACTIVE
+):
+    if settings.WORKER_TASK_PROTOCOL == 2:
+        messages = worker_messages_v2(image_variants, image_data, job_class)
     else:
-        return
+        messages = [
+            worker_message(variant, image_data, job_class) for variant in image_variants
+        ]
 
-    channel.queue_declare(queue=queue, durable=True)
+    publisher.publish_batch([message for message in messages if message])
 
-    channel.basic_publish(
-        exchange="",
-        routing_key=queue,
-        body=json.dumps(message).encode("utf-8"),
-        properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent),
-    )
 
-    connection.close()
+def send_image_to_worker(
+    image_variant, image_data: BytesIO | None = None, job_class=INTERACTIVE
+):
+    send_images_to_worker([image_variant], image_data, job_class)
+
+
+def send_resize_task(image, width, height, gaussian_blur, brightness):
+    message = {
+        "image_id": str(image.id),
+        "width": width,
+        "height": height,
+        "gaussian_blur": gaussian_blur,
+        "brightness": brightness,
+    }
+
+    publisher.publish("kakigoori_resize", json.dumps(message).encode("utf-8"))
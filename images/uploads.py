@@ -0,0 +1,138 @@
+import hashlib
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+
+from images.exif import UnsupportedImage, exiftool, strip_gps_chunks
+from images.utils import get_s3_client
+
+
+class HashingReader:
+    def __init__(self, file, file_hash):
+        self.file = file
+        self.file_hash = file_hash
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.file_hash.update(data)
+        return data
+
+
+class S3StreamingUpload:
+    # Parts are sent as soon as they are full. Files smaller than one part are sent with a single PutObject, as a
+    # multipart upload would need three requests.
+
+    def __init__(self, key, content_type):
+        self.key = key
+        self.content_type = content_type
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+
+    def _upload_part(self):
+        s3_client = get_s3_client()
+
+        if self.upload_id is None:
+            self.upload_id = s3_client.create_multipart_upload(
+                Bucket=settings.S3_BUCKET, Key=self.key, ContentType=self.content_type
+            )["UploadId"]
+
+        part_number = len(self.parts) + 1
+        response = s3_client.upload_part(
+            Bucket=settings.S3_BUCKET,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buffer),
+        )
+
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self.buffer.clear()
+
+    def write(self, data):
+        self.buffer.extend(data)
+
+        if len(self.buffer) >= settings.S3_MULTIPART_PART_SIZE:
+            self._upload_part()
+
+    def complete(self):
+        if self.upload_id is None:
+            get_s3_client().put_object(
+                Bucket=settings.S3_BUCKET,
+                Key=self.key,
+                Body=bytes(self.buffer),
+                ContentType=self.content_type,
+            )
+            self.buffer.clear()
+            return
+
+        if self.buffer:
+            self._upload_part()
+
+        get_s3_client().complete_multipart_upload(
+            Bucket=settings.S3_BUCKET,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+    def abort(self):
+        if self.upload_id is not None:
+            get_s3_client().abort_multipart_upload(
+                Bucket=settings.S3_BUCKET, Key=self.key, UploadId=self.upload_id
+            )
+
+        self.buffer.clear()
+        self.upload_id = None
+        self.parts = []
+
+
+class OriginalUpload:
+    # The uploaded file is read once: it is hashed, its GPS data is removed and it is sent to S3 chunk by chunk. The
+    # only copy kept is the one given to the worker, which goes to disk when it gets large.
+
+    def __init__(self, file, key, content_type):
+        self.file = file
+        self.s3_upload = S3StreamingUpload(key, content_type)
+        self.image_data = SpooledTemporaryFile(max_size=settings.UPLOAD_SPOOL_MAX_SIZE)
+        self.original_md5 = hashlib.md5()
+        self.size = 0
+
+    def _write(self, chunk):
+        self.s3_upload.write(chunk)
+        self.image_data.write(chunk)
+        self.size += len(chunk)
+
+    def stream(self):
+        self.file.seek(0)
+
+        try:
+            for chunk in strip_gps_chunks(HashingReader(self.file, self.original_md5)):
+                self._write(chunk)
+        except UnsupportedImage:
+            if not settings.EXIFTOOL_FALLBACK:
+                self.abort()
+                raise
+
+            self.s3_upload.abort()
+            self.image_data.seek(0)
+            self.image_data.truncate()
+            self.size = 0
+
+            self.file.seek(0)
+            original_data = self.file.read()
+            self.original_md5 = hashlib.md5(original_data)
+            self._write(exiftool.remove_gps(original_data))
+
+        self.image_data.seek(0)
+
+    @property
+    def md5_hexdigest(self):
+        return self.original_md5.hexdigest()
+
+    def complete(self):
+        self.s3_upload.complete()
+
+    def abort(self):
+        self.s3_upload.abort()
+        self.image_data.close()
@@ -1,24 +1,36 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
+if settings.ASYNC_IMAGE_VIEWS:
+    get_view = views.get_async
+    get_thumbnail_view = views.get_thumbnail_async
+    get_image_with_height_view = views.get_image_with_height_async
+    get_image_with_width_view = views.get_image_with_width_async
+else:
+    get_view = views.get
+    get_thumbnail_view = views.get_thumbnail
+    get_image_with_height_view = views.get_image_with_height
+    get_image_with_width_view = views.get_image_with_width
+
 urlpatterns = [
     path("", views.index, name="index"),
     path("upload", views.upload, name="images.upload"),
-    path("<uuid:image_id>/<str:image_type>", views.get, name="images.get"),
+    path("<uuid:image_id>/<str:image_type>", get_view, name="images.get"),
     path(
         "<uuid:image_id>/<str:image_type>/thumbnail",
-        views.get_thumbnail,
+        get_thumbnail_view,
         name="images.get_thumbnail",
     ),
     path(
         "<uuid:image_id>/height/<int:height>/<str:image_type>",
-        views.get_image_with_height,
+        get_image_with_height_view,
         name="images.get_image_with_height",
     ),
     path(
         "<uuid:image_id>/width/<int:width>/<str:image_type>",
-        views.get_image_with_width,
+        get_image_with_width_view,
         name="images.get_image_with_width",
     ),
 ]
@@ -1,30 +1,133 @@
-import subprocess
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import valkey
+from asgiref.sync import sync_to_async
 from botocore.config import Config
 from django.conf import settings
+from django.db import connections
 
+_valkey_client = None
 
-def get_b2_resource():
-    b2 = boto3.resource(
-        service_name="s3",
-        endpoint_url=settings.S3_ENDPOINT,
-        aws_access_key_id=settings.S3_KEY_ID,
-        aws_secret_access_key=settings.S3_SECRET_KEY,
-        config=Config(signature_version="s3v4"),
+_blocking_executor = None
+_blocking_executor_lock = threading.Lock()
+
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_config() -> Config:
+    return Config(
+        signature_version="s3v4",
+        max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        retries={
+            "mode": settings.S3_RETRY_MODE,
+            "total_max_attempts": settings.S3_MAX_ATTEMPTS,
+        },
     )
 
-    bucket = b2.Bucket(settings.S3_BUCKET)
 
-    return bucket
+def get_s3_client():
+    global _s3_client, _s3_client_pid
 
+    # Clients are thread safe, but their connections can't be shared with a forked process
+    if _s3_client is None or _s3_client_pid != os.getpid():
+        with _s3_client_lock:
+            if _s3_client is None or _s3_client_pid != os.getpid():
+                _s3_client = boto3.session.Session().client(
+                    service_name="s3",
+                    endpoint_url=settings.S3_ENDPOINT,
+                    aws_access_key_id=settings.S3_KEY_ID,
+                    aws_secret_access_key=settings.S3_SECRET_KEY,
+                    config=get_s3_config(),
+                )
+                _s3_client_pid = os.getpid()
 
-def remove_exif_gps_data(image_data: bytes) -> bytes:
-    result = subprocess.run(
-        ["exiftool", "-gps:all=", "-"], input=image_data, capture_output=True
-    )
+    return _s3_client
+
+
+def get_valkey_client() -> valkey.Valkey | None:
+    global _valkey_client
+
+    if not settings.VALKEY_URL:
+        return None
+
+    if _valkey_client is None:
+        _valkey_client = valkey.Valkey.from_url(settings.VALKEY_URL)
+
+    return _valkey_client
+
+
+def get_blocking_executor() -> ThreadPoolExecutor:
+    global _blocking_executor
+
+    if _blocking_executor is None:
+        with _blocking_executor_lock:
+            if _blocking_executor is None:
+                _blocking_executor = ThreadPoolExecutor(
+                    max_workers=settings.ASYNC_BLOCKING_WORKERS,
+                    thread_name_prefix="kakigoori-blocking",
+                )
+
+    return _blocking_executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    def run():
+        try:
+            return func(*args, **kwargs)
+        finally:
+            # The threads of the pool outlive the requests, so their database connections are given back to the
+            # pool after each call
+            connections.close_all()
+
+    return await sync_to_async(
+        run, thread_sensitive=False, executor=get_blocking_executor()
+    )()
+
+
+class LRUCache:
+    # In-process cache, shared by the threads of a process. Entries expire after their TTL, and the least recently
+    # used ones are removed once max_size is reached.
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        # Returns a (found, value) tuple, as None can be a cached value
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+
+            expiry, value = entry
+            if expiry < time.monotonic():
+                del self._entries[key]
+                return False, None
+
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
 
-    if not result.check_returncode():
-        return result.stdout
-    else:
-        raise Exception(result.stderr)
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -2,26 +2,58 @@ import hashlib
 import os
 import random
 import string
+from datetime import timedelta
 from io import BytesIO
 
 from PIL import Image as PILImage
 from PIL import JpegImagePlugin
 from django.conf import settings
+from django.db.models import Case, Value, When
 from django.http import (
     JsonResponse,
     HttpResponseBadRequest,
-    HttpResponseNotFound,
 )
 from django.shortcuts import redirect, render
+from django.urls import reverse
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+)
+from django.utils import timezone
+from django.utils.http import quote_etag
 from django.views.decorators.csrf import csrf_exempt
 
+from images.cache import (
+    clear_resize_pending,
+    get_cached_variant_url,
+    mark_resize_pending,
+    negotiated_formats,
+    set_cached_variant_url,
+)
 from images.decorators import (
     get_image,
+    get_image_async,
     can_upload_variant,
     can_upload_image,
 )
-from images.models import Image, ImageVariant
-from images.utils import get_b2_resource, remove_exif_gps_data
+from images.models import (
+    THUMBNAIL_SIZE,
+    Image,
+    ImageVariant,
+    VariantCreationTimeout,
+    thumbnail_size,
+)
+from images.serving import (
+    accel_redirect,
+    stream_variant,
+    stream_variant_async,
+    variant_key,
+)
+from images.sizes import get_size_ladder, record_snapped_size, snap_size
+from images.tasks import send_resize_task
+from images.uploads import OriginalUpload
+from images.utils import run_blocking
 
 JpegImagePlugin._getmp = lambda x: None
 
@@ -37,8 +69,6 @@ def index(request):
 def upload(request):
     file = request.FILES["file"]
 
-    bucket = get_b2_resource()
-
     filename = file.name
 
     with PILImage.open(file) as im:
@@ -67,18 +97,30 @@ def upload(request):
             content_type = "image/jpeg"
             file_extension = "jpg"
 
-    file.seek(0)
-    file_md5_hash = hashlib.file_digest(file, "md5").hexdigest()
-    file.seek(0)
+    variant = ImageVariant(
+        height=height,
+        width=width,
+        file_type=file_extension,
+        is_full_size=True,
+        available=True,
+        is_primary_variant=True,
+    )
+
+    # The original is uploaded before the duplicate check, but the upload is only completed if the image is new
+    original_upload = OriginalUpload(file, variant.s3_filepath, content_type)
+    original_upload.stream()
 
-    same_md5_image = Image.objects.filter(original_md5=file_md5_hash).first()
+    same_md5_image = Image.objects.filter(
+        original_md5=original_upload.md5_hexdigest
+    ).first()
     if same_md5_image:
+        original_upload.abort()
         return JsonResponse({"created": False, "id": same_md5_image.id})
 
     image = Image(
         original_name=filename,
         original_mime_type=content_type,
-        original_md5=file_md5_hash,
+        original_md5=original_upload.md5_hexdigest,
         height=height,
         width=width,
         version=3,
@@ -86,100 +128,274 @@ def upload(request):
 
     image.save()
 
-    variant, _ = ImageVariant.objects.get_or_create(
-        image=image,
-        height=height,
-        width=width,
-        file_type=file_extension,
-        is_full_size=True,
-        available=True,
-        is_primary_variant=True,
-    )
-
-    image_data = remove_exif_gps_data(file.read())
+    variant.image = image
+    variant.file_size = original_upload.size
+    variant.save()
 
-    bucket.put_object(
-        Body=image_data,
-        Key=variant.s3_filepath,
-        ContentType=content_type,
-    )
+    try:
+        original_upload.complete()
+    except Exception:
+        original_upload.abort()
+        raise
 
-    image.create_variant_tasks(variant, BytesIO(image_data))
+    image.create_variant_tasks(variant, original_upload.image_data)
     image.uploaded = True
     image.save()
 
     return JsonResponse({"created": True, "id": image.id}, status=201)
 
 
-def image_with_size(request, image, width, height, image_type):
-    gaussian_blur = float(request.GET.get("gaussian_blur", 0))
-    brightness = float(request.GET.get("brightness", 1))
+def variant_etag(url):
+    # The ETag only depends on the variant served, so shared caches can revalidate their copy
+    return quote_etag(hashlib.md5(url.encode("utf-8")).hexdigest())
+
+
+def patch_variant_headers(response, etag, image_type, max_age):
+    response["ETag"] = etag
+    patch_cache_control(response, public=True, max_age=max_age)
+    if image_type == "auto":
+        patch_vary_headers(response, ["Accept"])
+
+    return response
+
+
+def variant_response(request, url, image_type, max_age):
+    etag = variant_etag(url)
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        if settings.IMAGE_SERVING_MODE == "proxy":
+            response = stream_variant(request, variant_key(url))
+        elif settings.IMAGE_SERVING_MODE == "accel":
+            response = accel_redirect(variant_key(url))
+        else:
+            response = redirect(url)
+
+    return patch_variant_headers(response, etag, image_type, max_age)
 
-    image_variants = ImageVariant.objects.filter(
-        image=image,
+
+async def variant_response_async(request, url, image_type, max_age):
+    etag = variant_etag(url)
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        if settings.IMAGE_SERVING_MODE == "proxy":
+            response = await stream_variant_async(request, variant_key(url))
+        elif settings.IMAGE_SERVING_MODE == "accel":
+            response = accel_redirect(variant_key(url))
+        else:
+            response = redirect(url)
+
+    return patch_variant_headers(response, etag, image_type, max_age)
+
+
+def pending_better_variants(
+    image, width, height, gaussian_blur, brightness, variants_preferred_order, file_type
+):
+    # Optimized variants preferred to the served one that are still being encoded. Only one of jpg and png exists
+    # for an image, and the format policy can skip the optimized formats, so only the variants actually waiting for
+    # the worker count. Variants waiting for longer than VARIANT_PENDING_TIMEOUT were lost on the way, e.g. their
+    # task was never sent, and are ignored.
+    better_file_types = [
+        preferred_file_type
+        for preferred_file_type in variants_preferred_order[
+            : variants_preferred_order.index(file_type)
+        ]
+        if preferred_file_type in ["avif", "webp"]
+    ]
+
+    return ImageVariant.objects.filter(
+        image_id=image.id,
         height=height,
         width=width,
         gaussian_blur=gaussian_blur,
         brightness=brightness,
-        available=True,
+        available=False,
+        file_type__in=better_file_types,
+        creation_date__gte=timezone.now()
+        - timedelta(seconds=settings.VARIANT_PENDING_TIMEOUT),
     )
-    if image_type != "auto":
-        if image_type == "original":
-            image_variants = image_variants.filter(file_type__in=["jpg", "png"])
-        else:
-            image_variants = image_variants.filter(file_type=image_type)
 
-    variants = image_variants.all()
 
-    if not variants:
-        if image_type != "auto" and image_type != "original":
-            return JsonResponse({"error": "Image version not available"}, status=404)
-        else:
-            image_variant = image.create_variant(
-                width, height, gaussian_blur, brightness
-            )
+def fallback_variant_url(image, width, height, gaussian_blur, brightness, file_types):
+    fallback_variant = image.closest_larger_variant(
+        width, height, gaussian_blur, brightness, file_types
+    )
+
+    return f"{settings.S3_PUBLIC_BASE_PATH}/{fallback_variant.s3_filepath}"
+
+
+def request_resize(image, width, height, gaussian_blur, brightness):
+    if not mark_resize_pending(image.id, width, height, gaussian_blur, brightness):
+        return
+
+    try:
+        send_resize_task(image, width, height, gaussian_blur, brightness)
+    except Exception:
+        # Otherwise no other request would send the task until the pending mark expires
+        clear_resize_pending(image.id, width, height, gaussian_blur, brightness)
+        raise
+
+
+def snapped_size_redirect(request, view_name, image, image_type, **size):
+    url = reverse(
+        view_name, kwargs={"image_id": image.id, "image_type": image_type, **size}
+    )
+    if request.META.get("QUERY_STRING"):
+        url += "?" + request.META["QUERY_STRING"]
 
-            return redirect(
-                f"{settings.S3_PUBLIC_BASE_PATH}/{image_variant.s3_filepath}"
+    response = redirect(url)
+    patch_cache_control(response, max_age=settings.SIZE_LADDER_REDIRECT_MAX_AGE)
+
+    return response
+
+
+def ladder_thumbnail_size(image):
+    # Images smaller than a thumbnail are still enlarged to it, as without the ladder
+    long_side = snap_size(
+        THUMBNAIL_SIZE,
+        max(THUMBNAIL_SIZE, image.width, image.height),
+        get_size_ladder(),
+    )
+
+    return thumbnail_size(image.width, image.height, long_side)
+
+
+def available_variants(
+    image, width, height, gaussian_blur, brightness, variants_preferred_order
+):
+    # Format negotiation is done by the database, so only the preferred variant is fetched
+    return (
+        ImageVariant.objects.filter(
+            image_id=image.id,
+            height=height,
+            width=width,
+            gaussian_blur=gaussian_blur,
+            brightness=brightness,
+            available=True,
+            file_type__in=variants_preferred_order,
+        )
+        .annotate(
+            preference=Case(
+                *[
+                    When(file_type=file_type, then=Value(position))
+                    for position, file_type in enumerate(variants_preferred_order)
+                ]
             )
+        )
+        .order_by("preference")
+    )
 
-    if image_type == "auto":
-        variants_preferred_order = ["avif", "webp", "jpg", "png"]
-    elif image_type == "original":
-        variants_preferred_order = ["jpg", "png"]
-    else:
-        variants_preferred_order = [image_type]
 
-    accept_header = request.headers.get("Accept", default="")
+def image_with_size(request, image, width, height, image_type):
+    gaussian_blur = float(request.GET.get("gaussian_blur", 0))
+    brightness = float(request.GET.get("brightness", 1))
+
+    variants_preferred_order = negotiated_formats(
+        image_type, request.headers.get("Accept", default="")
+    )
 
-    for file_type in variants_preferred_order:
-        if (
-            file_type == "avif"
-            and image_type == "auto"
-            and "image/avif" not in accept_header
-        ):
-            continue
+    cached_url, cache_generation = get_cached_variant_url(
+        image.id, width, height, gaussian_blur, brightness, variants_preferred_order
+    )
+    if cached_url:
+        return variant_response(
+            request,
+            cached_url,
+            image_type,
+            settings.VARIANT_MAX_AGE,
+        )
+
+    variant = (
+        available_variants(
+            image, width, height, gaussian_blur, brightness, variants_preferred_order
+        )
+        .only("id", "file_type")
+        .first()
+    )
+
+    if variant is None:
+        if image_type != "auto" and image_type != "original":
+            return JsonResponse({"error": "Image version not available"}, status=404)
 
-        if (
-            file_type == "webp"
-            and image_type == "auto"
-            and "image/webp" not in accept_header
-        ):
-            continue
+        if settings.VARIANT_CREATION_NON_BLOCKING:
+            request_resize(image, width, height, gaussian_blur, brightness)
 
-        variant = [x for x in image_variants if x.file_type == file_type]
-        if not variant:
-            continue
+            url = fallback_variant_url(
+                image,
+                width,
+                height,
+                gaussian_blur,
+                brightness,
+                variants_preferred_order,
+            )
+            return variant_response(
+                request, url, image_type, settings.VARIANT_FALLBACK_MAX_AGE
+            )
 
-        variant = variant[0]
+        try:
+            variant = image.create_variant(width, height, gaussian_blur, brightness)
+        except VariantCreationTimeout:
+            # Another request is still generating this variant, serve a larger one in the meantime
+            url = fallback_variant_url(
+                image,
+                width,
+                height,
+                gaussian_blur,
+                brightness,
+                variants_preferred_order,
+            )
+            return variant_response(
+                request, url, image_type, settings.VARIANT_FALLBACK_MAX_AGE
+            )
 
-        return redirect(f"{settings.S3_PUBLIC_BASE_PATH}/{variant.s3_filepath}")
+    url = f"{settings.S3_PUBLIC_BASE_PATH}/{variant.s3_filepath}"
+
+    # Until the better format is encoded, the variant is neither cached here nor for long by the clients
+    if pending_better_variants(
+        image,
+        width,
+        height,
+        gaussian_blur,
+        brightness,
+        variants_preferred_order,
+        variant.file_type,
+    ).exists():
+        return variant_response(
+            request, url, image_type, settings.VARIANT_FALLBACK_MAX_AGE
+        )
+
+    set_cached_variant_url(
+        image.id,
+        width,
+        height,
+        gaussian_blur,
+        brightness,
+        variants_preferred_order,
+        url,
+        cache_generation,
+    )
 
-    return HttpResponseNotFound()
+    return variant_response(request, url, image_type, settings.VARIANT_MAX_AGE)
 
 
 @get_image
 def get_image_with_height(request, image, height, image_type):
+    snapped_height = snap_size(height, image.height, get_size_ladder())
+    if snapped_height != height:
+        record_snapped_size(image.id, "height", height, snapped_height)
+
+        if settings.SIZE_LADDER_REDIRECT:
+            return snapped_size_redirect(
+                request,
+                "images.get_image_with_height",
+                image,
+                image_type,
+                height=snapped_height,
+            )
+
+        height = snapped_height
+
     if height >= image.height:
         height = image.height
         width = image.width
@@ -191,6 +407,21 @@ def get_image_with_height(request, image, height, image_type):
 
 @get_image
 def get_image_with_width(request, image, width, image_type):
+    snapped_width = snap_size(width, image.width, get_size_ladder())
+    if snapped_width != width:
+        record_snapped_size(image.id, "width", width, snapped_width)
+
+        if settings.SIZE_LADDER_REDIRECT:
+            return snapped_size_redirect(
+                request,
+                "images.get_image_with_width",
+                image,
+                image_type,
+                width=snapped_width,
+            )
+
+        width = snapped_width
+
     if width >= image.width:
         width = image.width
         height = image.height
@@ -207,6 +438,183 @@ def get(request, image, image_type):
 
 @get_image
 def get_thumbnail(request, image, image_type):
-    width, height = image.thumbnail_size
+    width, height = ladder_thumbnail_size(image)
 
     return image_with_size(request, image, width, height, image_type)
+
+
+# Async versions of the image views, used when serving through ASGI. The database lookups use the async ORM, and
+# everything else that blocks (Valkey, RabbitMQ, S3 and Pillow) runs in a bounded thread pool.
+
+
+async def image_with_size_async(request, image, width, height, image_type):
+    gaussian_blur = float(request.GET.get("gaussian_blur", 0))
+    brightness = float(request.GET.get("brightness", 1))
+
+    variants_preferred_order = negotiated_formats(
+        image_type, request.headers.get("Accept", default="")
+    )
+
+    cached_url, cache_generation = await run_blocking(
+        get_cached_variant_url,
+        image.id,
+        width,
+        height,
+        gaussian_blur,
+        brightness,
+        variants_preferred_order,
+    )
+    if cached_url:
+        return await variant_response_async(
+            request,
+            cached_url,
+            image_type,
+            settings.VARIANT_MAX_AGE,
+        )
+
+    variant = await (
+        available_variants(
+            image, width, height, gaussian_blur, brightness, variants_preferred_order
+        )
+        .only("id", "file_type")
+        .afirst()
+    )
+
+    if variant is None:
+        if image_type != "auto" and image_type != "original":
+            return JsonResponse({"error": "Image version not available"}, status=404)
+
+        if settings.VARIANT_CREATION_NON_BLOCKING:
+            await run_blocking(
+                request_resize, image, width, height, gaussian_blur, brightness
+            )
+
+            url = await run_blocking(
+                fallback_variant_url,
+                image,
+                width,
+                height,
+                gaussian_blur,
+                brightness,
+                variants_preferred_order,
+            )
+            return await variant_response_async(
+                request, url, image_type, settings.VARIANT_FALLBACK_MAX_AGE
+            )
+
+        try:
+            variant = await run_blocking(
+                image.create_variant, width, height, gaussian_blur, brightness
+            )
+        except VariantCreationTimeout:
+            url = await run_blocking(
+                fallback_variant_url,
+                image,
+                width,
+                height,
+                gaussian_blur,
+                brightness,
+                variants_preferred_order,
+            )
+            return await variant_response_async(
+                request, url, image_type, settings.VARIANT_FALLBACK_MAX_AGE
+            )
+
+    url = f"{settings.S3_PUBLIC_BASE_PATH}/{variant.s3_filepath}"
+
+    if await pending_better_variants(
+        image,
+        width,
+        height,
+        gaussian_blur,
+        brightness,
+        variants_preferred_order,
+        variant.file_type,
+    ).aexists():
+        return await variant_response_async(
+            request, url, image_type, settings.VARIANT_FALLBACK_MAX_AGE
+        )
+
+    await run_blocking(
+        set_cached_variant_url,
+        image.id,
+        width,
+        height,
+        gaussian_blur,
+        brightness,
+        variants_preferred_order,
+        url,
+        cache_generation,
+    )
+
+    return await variant_response_async(
+        request, url, image_type, settings.VARIANT_MAX_AGE
+    )
+
+
+@get_image_async
+async def get_image_with_height_async(request, image, height, image_type):
+    snapped_height = snap_size(height, image.height, get_size_ladder())
+    if snapped_height != height:
+        await run_blocking(
+            record_snapped_size, image.id, "height", height, snapped_height
+        )
+
+        if settings.SIZE_LADDER_REDIRECT:
+            return snapped_size_redirect(
+                request,
+                "images.get_image_with_height",
+                image,
+                image_type,
+                height=snapped_height,
+            )
+
+        height = snapped_height
+
+    if height >= image.height:
+        height = image.height
+        width = image.width
+    else:
+        width = int(height * image.width / image.height)
+
+    return await image_with_size_async(request, image, width, height, image_type)
+
+
+@get_image_async
+async def get_image_with_width_async(request, image, width, image_type):
+    snapped_width = snap_size(width, image.width, get_size_ladder())
+    if snapped_width != width:
+        await run_blocking(record_snapped_size, image.id, "width", width, snapped_width)
+
+        if settings.SIZE_LADDER_REDIRECT:
+            return snapped_size_redirect(
+                request,
+                "images.get_image_with_width",
+                image,
+                image_type,
+                width=snapped_width,
+            )
+
+        width = snapped_width
+
+    if width >= image.width:
+        width = image.width
+        height = image.height
+    else:
+        height = int(width * image.height / image.width)
+
+    return await image_with_size_async(request, image, width, height, image_type)
+
+
+@get_image_async
+async def get_async(request, image, image_type):
+    return await image_with_size_async(
+        request, image, image.width, image.height, image_type
+    )
+
+
+@get_image_async
+async def get_thumbnail_async(request, image, image_type):
+    width, height = ladder_thumbnail_size(image)
+
+    return await image_with_size_async(request, image, width, height, image_type)
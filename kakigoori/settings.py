@@ -151,6 +151,27 @@ if os.getenv("RABBITMQ_USER") and os.getenv("RABBITMQ_PASSWORD"):
 if os.getenv("RABBITMQ_VHOST"):
     RABBITMQ_CONNECTION_PARAMETERS.virtual_host = os.getenv("RABBITMQ_VHOST")
 
+# Seconds the web processes wait to connect to RabbitMQ, or while the broker blocks publishers, before giving up
+RABBITMQ_PUBLISH_TIMEOUT = float(os.getenv("RABBITMQ_PUBLISH_TIMEOUT", 10))
+
+# Version 1 of the worker protocol sends the images themselves, base64-encoded, through RabbitMQ. Version 2 only
+# sends their S3 keys, or their paths in WORKER_SHARED_STORAGE_PATH when it is set.
+WORKER_TASK_PROTOCOL = int(os.getenv("WORKER_TASK_PROTOCOL", 1))
+WORKER_COMBINED_QUEUE = get_env_boolean("WORKER_COMBINED_QUEUE")
+# Background and bulk encodes (resizes served with a fallback, regenerate_variants) are sent to their own queues, so
+# that the worker can handle the uploads first. Only enable it once the workers consume these queues.
+WORKER_JOB_CLASS_QUEUES = get_env_boolean("WORKER_JOB_CLASS_QUEUES")
+WORKER_SHARED_STORAGE_PATH = os.getenv("WORKER_SHARED_STORAGE_PATH")
+
+# worker_results_processing uploads the results with WORKER_RESULTS_CONCURRENCY threads, and marks the variants as
+# available in batches of up to WORKER_RESULTS_BATCH_SIZE, or every WORKER_RESULTS_BATCH_INTERVAL seconds.
+WORKER_RESULTS_CONCURRENCY = int(os.getenv("WORKER_RESULTS_CONCURRENCY", 8))
+WORKER_RESULTS_BATCH_SIZE = int(os.getenv("WORKER_RESULTS_BATCH_SIZE", 50))
+WORKER_RESULTS_BATCH_INTERVAL = float(os.getenv("WORKER_RESULTS_BATCH_INTERVAL", 0.5))
+WORKER_RESULTS_REPORT_INTERVAL = int(os.getenv("WORKER_RESULTS_REPORT_INTERVAL", 60))
+# Results that failed to upload are requeued after WORKER_RESULTS_RETRY_DELAY seconds. Malformed results are dropped.
+WORKER_RESULTS_RETRY_DELAY = float(os.getenv("WORKER_RESULTS_RETRY_DELAY", 10))
+
 # S3 Config
 
 S3_ENDPOINT = get_env_or_raise("S3_ENDPOINT")
@@ -158,6 +179,112 @@ S3_KEY_ID = get_env_or_raise("S3_KEY_ID")
 S3_SECRET_KEY = get_env_or_raise("S3_SECRET_KEY")
 S3_BUCKET = get_env_or_raise("S3_BUCKET")
 S3_PUBLIC_BASE_PATH = get_env_or_raise("S3_PUBLIC_BASE_PATH")
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 20))
+S3_RETRY_MODE = os.getenv("S3_RETRY_MODE", "adaptive")
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", 5))
+# Uploads larger than this are sent to S3 in multiple parts, it can't be lower than 5 MiB
+S3_MULTIPART_PART_SIZE = int(os.getenv("S3_MULTIPART_PART_SIZE", 8 * 1024**2))
+# The files of deleted variants are removed once the transaction is committed. When enabled, the deletion is sent to
+# the delete_objects_processing command instead of being done by the process deleting the variants.
+S3_DELETIONS_IN_BACKGROUND = get_env_boolean("S3_DELETIONS_IN_BACKGROUND")
+
+# How the image views serve the variants: "redirect" sends the client to S3_PUBLIC_BASE_PATH, "proxy" streams them
+# from S3 through Kakigoori, and "accel" lets the proxy in front of Kakigoori fetch them, through an
+# IMAGE_ACCEL_HEADER header (X-Accel-Redirect or X-Sendfile) set to IMAGE_ACCEL_PREFIX followed by the S3 key.
+IMAGE_SERVING_MODE = os.getenv("IMAGE_SERVING_MODE", "redirect")
+if IMAGE_SERVING_MODE not in ["redirect", "proxy", "accel"]:
+    raise EnvironmentError(f"Unknown IMAGE_SERVING_MODE {IMAGE_SERVING_MODE}")
+IMAGE_ACCEL_HEADER = os.getenv("IMAGE_ACCEL_HEADER", "X-Accel-Redirect")
+IMAGE_ACCEL_PREFIX = os.getenv("IMAGE_ACCEL_PREFIX", f"/{S3_BUCKET}/")
+IMAGE_PROXY_CHUNK_SIZE = int(os.getenv("IMAGE_PROXY_CHUNK_SIZE", 64 * 1024))
+
+# The copy of an upload given to the worker is kept in memory up to this size, and on disk above it
+UPLOAD_SPOOL_MAX_SIZE = int(os.getenv("UPLOAD_SPOOL_MAX_SIZE", 8 * 1024**2))
+
+# Valkey config
+
+VALKEY_URL = os.getenv("VALKEY_URL")
+
+VARIANT_CACHE_TTL = int(os.getenv("VARIANT_CACHE_TTL", 3600))
+
+# Sizes of the images, used by the serving views. Each process keeps IMAGE_CACHE_SIZE of them in memory for
+# IMAGE_CACHE_LOCAL_TTL seconds, and they are kept in Valkey for IMAGE_CACHE_TTL seconds.
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", 100_000))
+IMAGE_CACHE_LOCAL_TTL = int(os.getenv("IMAGE_CACHE_LOCAL_TTL", 3600))
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", 7 * 24 * 3600))
+
+# Variants
+
+# Seconds a request waits for another one creating the same variant before serving a fallback. It has to stay well
+# under the worker timeout of gunicorn (30 seconds by default), or the waiting requests get killed instead.
+VARIANT_CREATION_LOCK_TIMEOUT = float(os.getenv("VARIANT_CREATION_LOCK_TIMEOUT", 5))
+
+# When enabled, a missing variant is resized in the background by the
+# resize_variants_processing command, and the closest larger variant is
+# served in the meantime. Requires Valkey, which remembers the resizes already
+# requested, otherwise every request for the variant would send another task.
+VARIANT_CREATION_NON_BLOCKING = (
+    get_env_boolean("VARIANT_CREATION_NON_BLOCKING") and bool(VALKEY_URL)
+)
+VARIANT_FALLBACK_MAX_AGE = int(os.getenv("VARIANT_FALLBACK_MAX_AGE", 60))
+RESIZE_PENDING_TTL = int(os.getenv("RESIZE_PENDING_TTL", 300))
+
+# How long the redirects to a variant can be cached. Redirects to a fallback, or to a format when a better one is
+# still being encoded, use VARIANT_FALLBACK_MAX_AGE instead.
+VARIANT_MAX_AGE = int(os.getenv("VARIANT_MAX_AGE", 86400))
+# Optimized variants still not available after this many seconds are considered lost, and no longer keep the
+# redirects to the other formats from being cached.
+VARIANT_PENDING_TIMEOUT = int(os.getenv("VARIANT_PENDING_TIMEOUT", 600))
+
+# Blur and brightness are applied after downscaling, with the blur radius scaled to the new resolution. Disable to
+# apply them to the original, as older versions did.
+RESIZE_BEFORE_FILTERS = get_env_boolean("RESIZE_BEFORE_FILTERS", "true")
+
+# New variants are resized from an existing variant when one is at least this many times larger than the target
+VARIANT_SOURCE_MIN_SCALE = float(os.getenv("VARIANT_SOURCE_MIN_SCALE", 1.5))
+
+# Size ladder, disabled unless breakpoints or a step are set. Requested widths and heights, and the long side of the
+# thumbnails, are rounded up to the next rung, so that near-identical sizes share their variants. The rungs are the
+# comma-separated SIZE_LADDER breakpoints, and every SIZE_LADDER_STEP times larger size starting at SIZE_LADDER_MIN.
+# With SIZE_LADDER_REDIRECT, the requests are redirected to the URL of their rung instead of being served directly.
+SIZE_LADDER = [int(size) for size in os.getenv("SIZE_LADDER", "").split(",") if size]
+SIZE_LADDER_STEP = float(os.getenv("SIZE_LADDER_STEP", 0))
+SIZE_LADDER_MIN = int(os.getenv("SIZE_LADDER_MIN", 64))
+SIZE_LADDER_REDIRECT = get_env_boolean("SIZE_LADDER_REDIRECT")
+SIZE_LADDER_REDIRECT_MAX_AGE = int(os.getenv("SIZE_LADDER_REDIRECT_MAX_AGE", 86400))
+
+# Format policy, disabled unless FORMAT_POLICY is set. The sizes of the AVIF and WebP variants compared to their source
+# are recorded in Valkey for each kind of variant (pixel count, blur and transparency). Once FORMAT_POLICY_MIN_SAMPLES
+# variants of a kind have been encoded, a format is skipped when it saves less than FORMAT_POLICY_MIN_SAVINGS of the
+# source size, or less than FORMAT_POLICY_MIN_SAVED_BYTES bytes. FORMAT_POLICY_EXPLORATION of these encodes are still
+# done, to keep measuring the savings.
+FORMAT_POLICY = get_env_boolean("FORMAT_POLICY")
+FORMAT_POLICY_MIN_SAMPLES = int(os.getenv("FORMAT_POLICY_MIN_SAMPLES", 50))
+FORMAT_POLICY_MIN_SAVINGS = float(os.getenv("FORMAT_POLICY_MIN_SAVINGS", 0.1))
+FORMAT_POLICY_MIN_SAVED_BYTES = int(os.getenv("FORMAT_POLICY_MIN_SAVED_BYTES", 2048))
+FORMAT_POLICY_EXPLORATION = float(os.getenv("FORMAT_POLICY_EXPLORATION", 0.02))
+
+# Local cache for the originals used when resizing, disabled unless a path is set
+
+ORIGINALS_CACHE_PATH = os.getenv("ORIGINALS_CACHE_PATH")
+ORIGINALS_CACHE_MAX_BYTES = int(os.getenv("ORIGINALS_CACHE_MAX_BYTES", 5 * 1024**3))
+
+# GPS data is removed from uploads in-process for JPEG and PNG files. Other files, and files the in-process
+# implementation can't parse, go through a persistent exiftool process unless this is disabled.
+EXIFTOOL_FALLBACK = get_env_boolean("EXIFTOOL_FALLBACK", "true")
+
+# Use the async image views, for deployments through ASGI (uvicorn). Their blocking work runs in a thread pool
+# with at most ASYNC_BLOCKING_WORKERS threads per process.
+ASYNC_IMAGE_VIEWS = get_env_boolean("ASYNC_IMAGE_VIEWS", "false")
+ASYNC_BLOCKING_WORKERS = int(os.getenv("ASYNC_BLOCKING_WORKERS", 16))
+
+# Authorization keys are cached by each process. Changes are applied immediately in every process when Valkey is
+# configured, and after at most the TTL in the other processes otherwise.
+AUTHORIZATION_KEY_CACHE_SIZE = int(os.getenv("AUTHORIZATION_KEY_CACHE_SIZE", 1024))
+AUTHORIZATION_KEY_CACHE_TTL = int(os.getenv("AUTHORIZATION_KEY_CACHE_TTL", 60))
+AUTHORIZATION_KEY_NEGATIVE_CACHE_TTL = int(
+    os.getenv("AUTHORIZATION_KEY_NEGATIVE_CACHE_TTL", 10)
+)
 
 # Postgres config
 
@@ -166,6 +293,15 @@ POSTGRES_USER = get_env_or_raise("POSTGRES_USER")
 POSTGRES_PASSWORD = get_env_or_raise("POSTGRES_PASSWORD")
 POSTGRES_DB = get_env_or_raise("POSTGRES_DB")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
+# Number of database connections each process keeps open, and the most it opens. Threads waiting for a connection
+# fail after 30 seconds. With the async views, every blocking thread can hold a connection, on top of the thread
+# running the async ORM queries.
+DB_POOL_MAX_SIZE = int(
+    os.getenv(
+        "DB_POOL_MAX_SIZE", ASYNC_BLOCKING_WORKERS + 1 if ASYNC_IMAGE_VIEWS else 4
+    )
+)
+DB_POOL_MIN_SIZE = min(int(os.getenv("DB_POOL_MIN_SIZE", 4)), DB_POOL_MAX_SIZE)
 
 DATABASES = {
     "default": {
@@ -177,7 +313,10 @@ DATABASES = {
         "PORT": POSTGRES_PORT,
         "CONN_MAX_AGE": 0,
         "OPTIONS": {
-            "pool": True,
+            "pool": {
+                "min_size": DB_POOL_MIN_SIZE,
+                "max_size": DB_POOL_MAX_SIZE,
+            },
         },
     }
 }
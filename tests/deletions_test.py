@@ -0,0 +1,66 @@
+import django
+import pytest
+from django.conf import settings
+from django.db import transaction
+
+from images import deletions
+from images.deletions import schedule_s3_deletion
+
+if not settings.configured:
+    settings.configure(
+        DATABASES={
+            "default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}
+        }
+    )
+    django.setup()
+
+
+@pytest.fixture
+def flushed(monkeypatch):
+    # Keys of each request sent to delete the objects
+    flushed = []
+    monkeypatch.setattr(deletions, "flush_s3_deletions", flushed.append)
+
+    return flushed
+
+
+def test_schedule_s3_deletion_outside_of_a_transaction(flushed):
+    schedule_s3_deletion("a", "default")
+
+    assert flushed == [["a"]]
+
+
+def test_schedule_s3_deletion_batches_a_transaction(flushed):
+    with transaction.atomic():
+        for key in ["a", "b", "c"]:
+            schedule_s3_deletion(key, "default")
+
+        assert flushed == []
+
+    assert flushed == [["a", "b", "c"]]
+
+
+def test_schedule_s3_deletion_skips_rolled_back_savepoints(flushed):
+    with transaction.atomic():
+        schedule_s3_deletion("a", "default")
+
+        with pytest.raises(ValueError):
+            with transaction.atomic():
+                schedule_s3_deletion("b", "default")
+                raise ValueError
+
+        schedule_s3_deletion("c", "default")
+
+    assert flushed == [["a", "c"]]
+
+
+def test_schedule_s3_deletion_skips_rolled_back_transactions(flushed):
+    with pytest.raises(ValueError):
+        with transaction.atomic():
+            schedule_s3_deletion("a", "default")
+            raise ValueError
+
+    with transaction.atomic():
+        schedule_s3_deletion("b", "default")
+
+    assert flushed == [["b"]]
@@ -0,0 +1,148 @@
+import shutil
+import subprocess
+import time
+import zlib
+from io import BytesIO
+
+import PIL.Image
+import pytest
+
+from images.exif import GPS_INFO_TAG, exiftool, strip_gps, strip_gps_chunks
+
+exiftool_available = shutil.which("exiftool") is not None
+
+
+def image_with_gps(image_format):
+    im = PIL.Image.new("RGB", (64, 48), (200, 100, 50))
+
+    exif = PIL.Image.Exif()
+    exif[0x010F] = "Kakigoori"
+    exif[0x0110] = "Test camera"
+    exif[0x0131] = "Test software"
+    exif[GPS_INFO_TAG] = {
+        1: "N",
+        2: (48.0, 51.0, 29.99),
+        3: "E",
+        4: (2.0, 17.0, 40.2),
+        5: b"\x00",
+        6: 35.0,
+    }
+
+    file = BytesIO()
+    im.save(file, format=image_format, exif=exif)
+    return file.getvalue()
+
+
+def read_exif(image_data):
+    with PIL.Image.open(BytesIO(image_data)) as im:
+        im.load()
+        return im.getexif()
+
+
+def png_chunks(image_data):
+    position = 8
+    while position < len(image_data):
+        length = int.from_bytes(image_data[position : position + 4], "big")
+        chunk_type = image_data[position + 4 : position + 8]
+        data = image_data[position + 8 : position + 8 + length]
+        crc = int.from_bytes(image_data[position + 8 + length : position + 12 + length])
+        yield chunk_type, data, crc
+        position += 12 + length
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG"])
+def test_strip_gps(image_format):
+    image_data = image_with_gps(image_format)
+    assert read_exif(image_data).get_ifd(GPS_INFO_TAG)
+
+    stripped_data = strip_gps(image_data)
+    exif = read_exif(stripped_data)
+
+    assert len(stripped_data) == len(image_data)
+    assert GPS_INFO_TAG not in exif
+    assert exif[0x010F] == "Kakigoori"
+    assert exif[0x0110] == "Test camera"
+    assert exif[0x0131] == "Test software"
+
+    with PIL.Image.open(BytesIO(image_data)) as im:
+        with PIL.Image.open(BytesIO(stripped_data)) as stripped_im:
+            assert im.tobytes() == stripped_im.tobytes()
+
+
+def test_strip_gps_keeps_jpeg_image_data():
+    image_data = image_with_gps("JPEG")
+    stripped_data = strip_gps(image_data)
+
+    start_of_scan = image_data.index(b"\xff\xda")
+    assert stripped_data[start_of_scan:] == image_data[start_of_scan:]
+
+
+def test_strip_gps_png_crc():
+    stripped_data = strip_gps(image_with_gps("PNG"))
+
+    for chunk_type, data, crc in png_chunks(stripped_data):
+        assert zlib.crc32(chunk_type + data) == crc
+
+
+def test_strip_gps_without_gps():
+    file = BytesIO()
+    PIL.Image.new("RGB", (64, 48)).save(file, format="JPEG")
+    image_data = file.getvalue()
+
+    assert strip_gps(image_data) == image_data
+
+
+@pytest.mark.skipif(not exiftool_available, reason="exiftool is not installed")
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG"])
+def test_strip_gps_matches_exiftool(image_format):
+    image_data = image_with_gps(image_format)
+
+    exiftool_data = subprocess.run(
+        ["exiftool", "-gps:all=", "-"],
+        input=image_data,
+        capture_output=True,
+        check=True,
+    ).stdout
+
+    def tags(data):
+        return subprocess.run(
+            ["exiftool", "-G1", "-s", "-a", "-EXIF:all", "-"],
+            input=data,
+            capture_output=True,
+            check=True,
+        ).stdout
+
+    assert tags(strip_gps(image_data)) == tags(exiftool_data)
+    assert tags(exiftool.remove_gps(image_data)) == tags(exiftool_data)
+
+
+@pytest.mark.skipif(not exiftool_available, reason="exiftool is not installed")
+def test_strip_gps_latency():
+    image_data = image_with_gps("JPEG")
+
+    start = time.perf_counter()
+    for _ in range(20):
+        subprocess.run(
+            ["exiftool", "-gps:all=", "-"],
+            input=image_data,
+            capture_output=True,
+            check=True,
+        )
+    subprocess_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(20):
+        strip_gps(image_data)
+    in_process_time = time.perf_counter() - start
+
+    assert in_process_time < subprocess_time
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG"])
+def test_strip_gps_chunks(image_format):
+    image_data = image_with_gps(image_format)
+
+    chunks = list(strip_gps_chunks(BytesIO(image_data), chunk_size=16))
+
+    assert len(chunks) > 1
+    assert b"".join(chunks) == strip_gps(image_data)
@@ -0,0 +1,128 @@
+from types import SimpleNamespace
+
+import pytest
+
+from images import formats
+from images.formats import format_bucket, optimized_file_types, parse_bucket_fields
+
+policy_settings = SimpleNamespace(
+    FORMAT_POLICY=True,
+    FORMAT_POLICY_MIN_SAMPLES=50,
+    FORMAT_POLICY_MIN_SAVINGS=0.1,
+    FORMAT_POLICY_MIN_SAVED_BYTES=2048,
+    FORMAT_POLICY_EXPLORATION=0.02,
+)
+
+variant = SimpleNamespace(
+    width=600, height=300, gaussian_blur=0, file_type="jpg", file_size=100_000
+)
+
+
+@pytest.fixture
+def observed(monkeypatch):
+    # Observed (count, savings) for each format, and the encodes the policy reports as skipped
+    savings = {}
+    skipped = {}
+
+    monkeypatch.setattr(formats, "settings", policy_settings)
+    monkeypatch.setattr(formats.random, "random", lambda: 0.5)
+    monkeypatch.setattr(
+        formats,
+        "get_observed_savings",
+        lambda buckets: {
+            format_bucket(file_type, 600, 300, 0, "jpg"): value
+            for file_type, value in savings.items()
+        },
+    )
+    monkeypatch.setattr(formats, "record_skipped_encodes", skipped.update)
+
+    return SimpleNamespace(savings=savings, skipped=skipped)
+
+
+def test_format_bucket_groups_similar_variants():
+    assert format_bucket("avif", 600, 300, 0, "jpg") == format_bucket(
+        "avif", 1000, 500, 0, "jpg"
+    )
+    assert format_bucket("avif", 600, 300, 0, "jpg") != format_bucket(
+        "avif", 3000, 1500, 0, "jpg"
+    )
+
+
+def test_format_bucket_separates_blur_and_transparency():
+    buckets = {
+        format_bucket("webp", 600, 300, gaussian_blur, source_file_type)
+        for gaussian_blur in [0, 10]
+        for source_file_type in ["jpg", "png"]
+    }
+
+    assert len(buckets) == 4
+
+
+def test_parse_bucket_fields():
+    fields = {
+        b"avif:8:sharp:opaque:count": b"3",
+        b"avif:8:sharp:opaque:encode_seconds": b"1.5",
+        b"webp:8:blurred:opaque:count": b"1",
+    }
+
+    assert parse_bucket_fields(fields) == {
+        "avif:8:sharp:opaque": {"count": 3, "encode_seconds": 1.5},
+        "webp:8:blurred:opaque": {"count": 1},
+    }
+
+
+def test_optimized_file_types_without_policy(observed, monkeypatch):
+    observed.savings.update(avif=(100, 0), webp=(100, 0))
+    monkeypatch.setattr(formats, "settings", SimpleNamespace(FORMAT_POLICY=False))
+
+    assert optimized_file_types(variant) == ["avif", "webp"]
+
+
+def test_optimized_file_types_without_source_size(observed):
+    observed.savings.update(avif=(100, 0), webp=(100, 0))
+
+    assert optimized_file_types(SimpleNamespace(file_size=None)) == ["avif", "webp"]
+
+
+def test_optimized_file_types_encodes_until_enough_samples(observed):
+    observed.savings.update(avif=(49, 0), webp=(100, 0))
+
+    assert optimized_file_types(variant) == ["avif"]
+
+
+def test_optimized_file_types_encodes_without_samples(observed, monkeypatch):
+    monkeypatch.setattr(
+        formats,
+        "settings",
+        SimpleNamespace(**{**vars(policy_settings), "FORMAT_POLICY_MIN_SAMPLES": 0}),
+    )
+    observed.savings.update(webp=(100, 0))
+
+    assert optimized_file_types(variant) == ["avif"]
+
+
+def test_optimized_file_types_skips_small_savings(observed):
+    observed.savings.update(avif=(100, 0.5), webp=(100, 0.05))
+
+    assert optimized_file_types(variant) == ["avif"]
+    assert observed.skipped == {format_bucket("webp", 600, 300, 0, "jpg"): 95_000}
+
+
+def test_optimized_file_types_skips_small_saved_bytes(observed):
+    observed.savings.update(avif=(100, 0.5), webp=(100, 0.5))
+
+    assert optimized_file_types(variant) == ["avif", "webp"]
+    assert (
+        optimized_file_types(SimpleNamespace(**{**vars(variant), "file_size": 4000}))
+        == []
+    )
+
+
+def test_optimized_file_types_explores_skipped_formats(observed, monkeypatch):
+    observed.savings.update(avif=(100, 0), webp=(100, 0))
+
+    assert optimized_file_types(variant) == []
+
+    monkeypatch.setattr(formats.random, "random", lambda: 0.01)
+
+    assert optimized_file_types(variant) == ["avif", "webp"]
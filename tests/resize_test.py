@@ -0,0 +1,56 @@
+import math
+import os
+
+import PIL.Image
+import pytest
+from PIL import ImageChops, ImageStat
+
+from images.processing import resize_image
+
+original_image_path = os.path.join(os.path.dirname(__file__), "103328382_p0.jpg")
+
+
+def psnr(image_a, image_b):
+    difference = ImageChops.difference(image_a.convert("RGB"), image_b.convert("RGB"))
+    stat = ImageStat.Stat(difference)
+    mse = sum(stat.sum2) / (len(stat.sum2) * image_a.width * image_a.height)
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(255**2 / mse)
+
+
+@pytest.mark.parametrize("width,height", [(600, 300), (1200, 600), (2000, 1000)])
+def test_shrink_on_load_matches_full_decode(width, height):
+    with open(original_image_path, "rb") as original_image:
+        fast_image, _ = resize_image(original_image, width, height, 0, 1)
+
+    with open(original_image_path, "rb") as original_image:
+        slow_image, _ = resize_image(
+            original_image, width, height, 0, 1, fast_path=False
+        )
+
+    fast_image = PIL.Image.open(fast_image)
+    slow_image = PIL.Image.open(slow_image)
+
+    assert fast_image.size == slow_image.size
+    assert psnr(fast_image, slow_image) > 40
+
+
+@pytest.mark.parametrize("gaussian_blur", [2, 10, 40])
+@pytest.mark.parametrize("brightness", [1, 0.6])
+def test_filters_after_resize_match_filters_on_original(gaussian_blur, brightness):
+    with open(original_image_path, "rb") as original_image:
+        resized_first_image, _ = resize_image(
+            original_image, 600, 300, gaussian_blur, brightness
+        )
+
+    with open(original_image_path, "rb") as original_image:
+        filtered_first_image, _ = resize_image(
+            original_image, 600, 300, gaussian_blur, brightness, resize_first=False
+        )
+
+    resized_first_image = PIL.Image.open(resized_first_image)
+    filtered_first_image = PIL.Image.open(filtered_first_image)
+
+    assert resized_first_image.size == filtered_first_image.size
+    assert psnr(resized_first_image, filtered_first_image) > 35
@@ -0,0 +1,36 @@
+import pytest
+
+from images.sizes import build_size_ladder, snap_size
+
+
+def test_build_size_ladder_from_breakpoints():
+    assert build_size_ladder([1200, 320, 640], 0, 64) == [320, 640, 1200]
+
+
+def test_build_size_ladder_geometric():
+    ladder = build_size_ladder([], 2, 100, 1000)
+
+    assert ladder == [100, 200, 400, 800]
+
+
+def test_build_size_ladder_small_step_terminates():
+    ladder = build_size_ladder([], 1.001, 10, 20)
+
+    assert ladder == list(range(10, 20))
+
+
+@pytest.mark.parametrize(
+    "size,expected",
+    [(1, 320), (320, 320), (321, 640), (700, 1200), (1200, 1200), (1500, 2000)],
+)
+def test_snap_size_rounds_up_to_the_next_rung(size, expected):
+    assert snap_size(size, 2000, [320, 640, 1200]) == expected
+
+
+def test_snap_size_never_exceeds_the_image():
+    assert snap_size(500, 600, [320, 640, 1200]) == 600
+    assert snap_size(5000, 600, [320, 640, 1200]) == 5000
+
+
+def test_snap_size_without_ladder():
+    assert snap_size(537, 2000, []) == 537
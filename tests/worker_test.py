@@ -4,6 +4,7 @@ import json
 import logging
 import os
 import sys
+import tempfile
 import uuid
 
 import PIL.Image
@@ -27,6 +28,10 @@ docker_image = DockerImage(
     os.path.join(os.path.dirname(os.path.dirname(__file__)), "worker")
 )
 
+shared_storage = tempfile.mkdtemp()
+# The worker doesn't run as root inside its container
+os.chmod(shared_storage, 0o777)
+
 logger = logging.getLogger()
 
 
@@ -42,6 +47,7 @@ def setup(request):
         },
         network=network,
     )
+    kakigoori_worker.with_volume_mapping(shared_storage, "/shared", "rw")
     kakigoori_worker.start()
 
     def cleanup():
@@ -95,3 +101,67 @@ def test_worker(file_format):
     )
 
     channel.start_consuming()
+
+
+def test_worker_v2():
+    connection = pika.BlockingConnection(rabbitmq.get_connection_params())
+    channel = connection.channel()
+    channel.queue_declare(queue="kakigoori_avif", durable=True)
+    channel.queue_declare(queue="process_variant", durable=True)
+
+    received_file_types = []
+
+    def process_variant_callback(ch, method, properties, body):
+        logger.info(f" [x] Received body!")
+        args = json.loads(body.decode("utf-8"))
+        assert args["version"] == 2
+
+        file_type = args["variant_id"]
+        output_path = os.path.join(shared_storage, f"output.{file_type}")
+        assert args["destination"] == {"path": f"/shared/output.{file_type}"}
+        assert args["size"] == os.path.getsize(output_path)
+
+        image = PIL.Image.open(output_path)
+        assert image.format.lower() == file_type
+
+        received_file_types.append(file_type)
+        if len(received_file_types) == 2:
+            channel.stop_consuming()
+            connection.close()
+
+    channel.basic_consume(
+        queue="process_variant",
+        on_message_callback=process_variant_callback,
+        auto_ack=True,
+    )
+
+    with open(os.path.join(os.path.dirname(__file__), "103328382_p0.jpg"), "rb") as f:
+        with open(os.path.join(shared_storage, "source"), "wb") as source:
+            source.write(f.read())
+
+    message = {
+        "version": 2,
+        "source": {"path": "/shared/source"},
+        "outputs": [
+            {
+                "variant_id": file_type,
+                "file_type": file_type,
+                "destination": {"path": f"/shared/output.{file_type}"},
+            }
+            for file_type in ["avif", "webp"]
+        ],
+    }
+
+    logger.info("Sending message")
+
+    channel.basic_publish(
+        exchange="",
+        routing_key="kakigoori_avif",
+        body=json.dumps(message).encode("utf-8"),
+        properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent),
+    )
+
+    channel.start_consuming()
+
+    assert sorted(received_file_types) == ["avif", "webp"]
+    assert not os.path.exists(os.path.join(shared_storage, "source"))
@@ -30,4 +30,52 @@
         #[serde(with = "base64")]
         pub variant_file: Vec<u8>,
         pub variant_id: String,
+        pub encode_seconds: f64,
+    }
+
+    fn default_version() -> u32 {
+        1
+    }
+
+    #[derive(Deserialize)]
+    pub struct TaskVersion {
+        #[serde(default = "default_version")]
+        pub version: u32,
+    }
+
+    #[derive(Deserialize, Serialize)]
+    #[serde(rename_all = "snake_case")]
+    pub enum ObjectLocation {
+        S3Key(String),
+        Path(String),
+    }
+
+    #[derive(Deserialize)]
+    pub struct TaskOutput {
+        pub variant_id: String,
+        pub file_type: String,
+        pub destination: ObjectLocation,
+    }
+
+    #[derive(Deserialize)]
+    pub struct TaskRequestV2 {
+        pub source: ObjectLocation,
+        pub outputs: Vec<TaskOutput>,
+    }
+
+    #[derive(Serialize)]
+    pub struct TaskResponseV2 {
+        pub version: u32,
+        pub variant_id: String,
+        pub destination: ObjectLocation,
+        pub size: usize,
+        pub encode_seconds: f64,
+    }
+
+    // Sent instead of a TaskResponseV2 when a variant couldn't be created, so Kakigoori stops waiting for it
+    #[derive(Serialize)]
+    pub struct TaskFailureV2 {
+        pub version: u32,
+        pub variant_id: String,
+        pub error: String,
     }
@@ -1,11 +1,18 @@
 mod file_processors;
 mod json_messages;
+mod storage;
 
-use crate::json_messages::{TaskRequest, TaskResponse};
+use crate::file_processors::FileProcessor;
+use crate::json_messages::{
+    ObjectLocation, TaskFailureV2, TaskOutput, TaskRequest, TaskRequestV2, TaskResponse,
+    TaskResponseV2, TaskVersion,
+};
+use crate::storage::Storage;
 use futures_lite::stream::StreamExt;
 use lapin::message::Delivery;
 use lapin::options::{
-    BasicAckOptions, BasicConsumeOptions, BasicPublishOptions, QueueDeclareOptions,
+    BasicAckOptions, BasicConsumeOptions, BasicPublishOptions, BasicQosOptions,
+    QueueDeclareOptions,
 };
 use lapin::protocol::constants::REPLY_SUCCESS;
 use lapin::types::ShortString;
@@ -13,17 +20,75 @@ use lapin::{
     types::FieldTable, BasicProperties, Channel, Connection, ConnectionProperties, Consumer,
 };
 use std::fs::File;
+use std::future::poll_fn;
 use std::io::{Read, Write};
+use std::sync::Arc;
+use std::task::Poll;
+use std::time::Instant;
 use std::{fs, io};
 
+type BoxedFileProcessor = Box<dyn FileProcessor + Send + Sync>;
+
 fn generate_consumer_tag(channel: &Channel) -> String {
     format!("ctag{}.{}", channel.id(), uuid::Uuid::new_v4())
 }
 
-async fn handle_task(
+fn file_processor(file_type: &str) -> Option<BoxedFileProcessor> {
+    match file_type {
+        "avif" => Some(Box::new(file_processors::Avif {})),
+        "webp" => Some(Box::new(file_processors::WebP {})),
+        _ => None,
+    }
+}
+
+fn content_type(file_type: &str) -> &'static str {
+    match file_type {
+        "avif" => "image/avif",
+        "webp" => "image/webp",
+        _ => "binary/octet-stream",
+    }
+}
+
+async fn publish_response(
+    process_variant_channel: &Channel,
+    payload: &[u8],
+) -> Result<(), io::Error> {
+    process_variant_channel
+        .basic_publish(
+            "".into(),
+            "process_variant".into(),
+            BasicPublishOptions::default(),
+            payload,
+            BasicProperties::default(),
+        )
+        .await
+        .map_err(|_| io::Error::from(io::ErrorKind::Other))?;
+
+    Ok(())
+}
+
+async fn publish_failure(
+    process_variant_channel: &Channel,
+    variant_id: String,
+    error: &io::Error,
+) -> Result<(), io::Error> {
+    let task_failure = TaskFailureV2 {
+        version: 2,
+        variant_id,
+        error: error.to_string(),
+    };
+
+    publish_response(
+        process_variant_channel,
+        serde_json::to_vec(&task_failure)?.as_slice(),
+    )
+    .await
+}
+
+async fn handle_task_v1(
     delivery: &Delivery,
     process_variant_channel: &Channel,
-    task_function: &impl file_processors::FileProcessor,
+    task_function: &(dyn FileProcessor + Send + Sync),
 ) -> Result<(), io::Error> {
     let task_request: TaskRequest = serde_json::from_slice(delivery.data.as_slice())?;
 
@@ -35,7 +100,9 @@ async fn handle_task(
     let mut input_file = File::create(&input_file_path)?;
     input_file.write_all(&task_request.original_file)?;
 
+    let started_at = Instant::now();
     let output = task_function.process(&input_file_path, &output_file_path)?;
+    let encode_seconds = started_at.elapsed().as_secs_f64();
 
     if !output.status.success() {
         return Err(io::Error::other(
@@ -55,37 +122,210 @@ async fn handle_task(
     let task_response = TaskResponse {
         variant_file: contents,
         variant_id: task_request.variant_id,
+        encode_seconds,
     };
 
-    process_variant_channel
-        .basic_publish(
-            "".into(),
-            "process_variant".into(),
-            BasicPublishOptions::default(),
-            serde_json::to_vec(&task_response)?.as_slice(),
-            BasicProperties::default(),
+    publish_response(
+        process_variant_channel,
+        serde_json::to_vec(&task_response)?.as_slice(),
+    )
+    .await
+}
+
+async fn handle_task_output(
+    input_file_path: &str,
+    task_output: TaskOutput,
+    process_variant_channel: &Channel,
+    storage: &Storage,
+) -> Result<(), io::Error> {
+    let task_function = file_processor(&task_output.file_type).ok_or_else(|| {
+        io::Error::other(format!("unsupported file type {}", &task_output.file_type))
+    })?;
+
+    let output_file_path = format!("/tmp/{}_output", &task_output.variant_id);
+
+    let started_at = Instant::now();
+    let output = task_function.process(input_file_path, &output_file_path)?;
+    let encode_seconds = started_at.elapsed().as_secs_f64();
+
+    if !output.status.success() {
+        return Err(io::Error::other(
+            format!("process returned error, status {:?}", output.status.code()),
+        ));
+    }
+
+    let contents = fs::read(&output_file_path)?;
+    fs::remove_file(&output_file_path)?;
+
+    storage
+        .write(
+            &task_output.destination,
+            &contents,
+            content_type(&task_output.file_type),
         )
+        .await?;
+
+    println!("Task {} succeeded! Sending...", &task_output.variant_id);
+
+    let task_response = TaskResponseV2 {
+        version: 2,
+        variant_id: task_output.variant_id,
+        destination: task_output.destination,
+        size: contents.len(),
+        encode_seconds,
+    };
+
+    publish_response(
+        process_variant_channel,
+        serde_json::to_vec(&task_response)?.as_slice(),
+    )
+    .await
+}
+
+// Version 2 tasks only contain the location of the source and of the results, which are read and written here
+// instead of going through RabbitMQ. One task can ask for several file types.
+fn remove_file_if_exists(path: &str) -> Result<(), io::Error> {
+    match fs::remove_file(path) {
+        Err(e) if e.kind() == io::ErrorKind::NotFound => Ok(()),
+        result => result,
+    }
+}
+
+async fn process_task_v2(
+    input_file_path: &str,
+    source: &ObjectLocation,
+    outputs: Vec<TaskOutput>,
+    process_variant_channel: &Channel,
+    storage: &Storage,
+) -> Result<(), io::Error> {
+    let input_result = storage
+        .read(source)
         .await
-        .map_err(|_| io::Error::from(io::ErrorKind::Other))?;
+        .and_then(|contents| fs::write(input_file_path, contents));
+
+    if let Err(e) = input_result {
+        for task_output in outputs {
+            publish_failure(process_variant_channel, task_output.variant_id, &e).await?;
+        }
+
+        return Err(e);
+    }
+
+    for task_output in outputs {
+        let variant_id = task_output.variant_id.clone();
+
+        let output_result = handle_task_output(
+            input_file_path,
+            task_output,
+            process_variant_channel,
+            storage,
+        )
+        .await;
+
+        if let Err(e) = output_result {
+            eprintln!("Error handling variant {variant_id}: {e}");
+
+            // The other variants of the task are still created
+            if let Err(e) = publish_failure(process_variant_channel, variant_id, &e).await {
+                eprintln!("Error sending the failure: {e}");
+            }
+        }
+    }
 
     Ok(())
 }
 
-async fn handle_queue(
-    consumer: &mut Consumer,
+async fn handle_task_v2(
+    delivery: &Delivery,
+    process_variant_channel: &Channel,
+    storage: &Storage,
+) -> Result<(), io::Error> {
+    let task_request: TaskRequestV2 = serde_json::from_slice(delivery.data.as_slice())?;
+
+    let task_id = uuid::Uuid::new_v4();
+
+    println!("New task! {task_id}");
+
+    let input_file_path = format!("/tmp/{task_id}_input");
+    let result = process_task_v2(
+        &input_file_path,
+        &task_request.source,
+        task_request.outputs,
+        process_variant_channel,
+        storage,
+    )
+    .await;
+
+    // The message is acknowledged whatever the outcome, so nothing reads these files again
+    let input_removed = remove_file_if_exists(&input_file_path);
+    let source_removed = match &task_request.source {
+        ObjectLocation::Path(path) => remove_file_if_exists(path),
+        ObjectLocation::S3Key(_) => Ok(()),
+    };
+
+    result.and(input_removed).and(source_removed)
+}
+
+async fn handle_task(
+    delivery: &Delivery,
+    process_variant_channel: &Channel,
+    task_function: Option<&(dyn FileProcessor + Send + Sync)>,
+    storage: &Storage,
+) -> Result<(), io::Error> {
+    let task_version: TaskVersion = serde_json::from_slice(delivery.data.as_slice())?;
+
+    match (task_version.version, task_function) {
+        (1, Some(task_function)) => {
+            handle_task_v1(delivery, process_variant_channel, task_function).await
+        }
+        (1, None) => Err(io::Error::other(
+            "version 1 tasks can't be sent to a queue shared by several file types",
+        )),
+        (2, _) => handle_task_v2(delivery, process_variant_channel, storage).await,
+        (version, _) => Err(io::Error::other(format!("unknown task version {version}"))),
+    }
+}
+
+// Consumers are polled in the order of their job classes, so a message of an earlier class is always handled before
+// the ones of later classes
+async fn next_delivery(consumers: &mut [Consumer]) -> Option<lapin::Result<Delivery>> {
+    poll_fn(|cx| {
+        let mut finished = 0;
+
+        for consumer in consumers.iter_mut() {
+            match consumer.poll_next(cx) {
+                Poll::Ready(Some(delivery)) => return Poll::Ready(Some(delivery)),
+                Poll::Ready(None) => finished += 1,
+                Poll::Pending => (),
+            }
+        }
+
+        if finished == consumers.len() {
+            Poll::Ready(None)
+        } else {
+            Poll::Pending
+        }
+    })
+    .await
+}
+
+async fn handle_queues(
+    consumers: &mut [Consumer],
     process_variant_channel: Channel,
-    task_function: &impl file_processors::FileProcessor,
+    task_function: Option<&(dyn FileProcessor + Send + Sync)>,
+    storage: &Storage,
 ) -> Result<(), lapin::Error> {
-    while let Some(delivery) = consumer.next().await {
+    while let Some(delivery) = next_delivery(consumers).await {
         println!("Received message!");
 
         let delivery = delivery.map_err(|_| io::Error::from(io::ErrorKind::Other))?;
 
-        let task_result = handle_task(&delivery, &process_variant_channel, task_function).await;
+        let task_result =
+            handle_task(&delivery, &process_variant_channel, task_function, storage).await;
 
         match task_result {
             Ok(_) => (),
-            Err(e) => eprintln!("Error handling task: {}", e),
+            Err(e) => eprintln!("Error handling task: {e}"),
         }
 
         delivery.ack(BasicAckOptions::default()).await?;
@@ -94,21 +334,28 @@ async fn handle_queue(
     Ok(())
 }
 
+fn job_class_queue(queue: &str, job_class: &str) -> String {
+    // Interactive jobs keep the queue used before job classes existed
+    if job_class == "interactive" {
+        queue.into()
+    } else {
+        format!("{queue}_{job_class}")
+    }
+}
+
 async fn handle_file_type(
     channel: Channel,
     channel_process_variant: Channel,
     queue: &str,
-    task_function: impl file_processors::FileProcessor,
+    job_classes: Vec<String>,
+    task_function: Option<BoxedFileProcessor>,
+    storage: Arc<Storage>,
 ) -> Result<Result<(), lapin::Error>, lapin::Error> {
     let queue_declare_options = QueueDeclareOptions {
         durable: true,
         ..Default::default()
     };
 
-    channel
-        .queue_declare(queue.into(), queue_declare_options, FieldTable::default())
-        .await?;
-
     channel_process_variant
         .queue_declare(
             "process_variant".into(),
@@ -117,16 +364,41 @@ async fn handle_file_type(
         )
         .await?;
 
-    let mut consumer = channel
-        .basic_consume(
-            queue.into(),
-            generate_consumer_tag(&channel).into(),
-            BasicConsumeOptions::default(),
-            FieldTable::default(),
-        )
-        .await?;
+    // Only one unacknowledged message per queue, so the messages waiting for the worker stay in RabbitMQ, where an
+    // interactive job can still overtake them
+    channel.basic_qos(1, BasicQosOptions::default()).await?;
+
+    let mut consumers = vec![];
+    for job_class in &job_classes {
+        let job_class_queue = job_class_queue(queue, job_class);
+
+        channel
+            .queue_declare(
+                job_class_queue.as_str().into(),
+                queue_declare_options,
+                FieldTable::default(),
+            )
+            .await?;
+
+        consumers.push(
+            channel
+                .basic_consume(
+                    job_class_queue.as_str().into(),
+                    generate_consumer_tag(&channel).into(),
+                    BasicConsumeOptions::default(),
+                    FieldTable::default(),
+                )
+                .await?,
+        );
+    }
 
-    Ok(handle_queue(&mut consumer, channel_process_variant, &task_function).await)
+    Ok(handle_queues(
+        &mut consumers,
+        channel_process_variant,
+        task_function.as_deref(),
+        &storage,
+    )
+    .await)
 }
 
 async fn connect_rabbit_mq() -> lapin::Result<(Connection, Vec<tokio::task::JoinHandle<Result<Result<(), lapin::Error>, lapin::Error>>>)> {
@@ -143,23 +415,42 @@ async fn connect_rabbit_mq() -> lapin::Result<(Connection, Vec<tokio::task::Join
         .unwrap_or_else(|_| "avif,webp".into())
         .to_lowercase();
 
+    // Job classes consumed by this worker, from the most to the least urgent
+    let job_classes: Vec<String> = std::env::var("WORKER_JOB_CLASSES")
+        .unwrap_or_else(|_| "interactive,background,bulk".into())
+        .to_lowercase()
+        .split(',')
+        .map(String::from)
+        .collect();
+
+    let storage = Arc::new(Storage::from_env()?);
+
     let mut tasks = vec![];
     for file_type in worker_file_types.split(',') {
         match file_type {
-            "avif" => {
+            "avif" | "webp" => {
                 tasks.push(tokio::spawn(handle_file_type(
                     conn.create_channel().await?,
                     conn.create_channel().await?,
-                    "kakigoori_avif",
-                    file_processors::Avif {},
+                    if file_type == "avif" {
+                        "kakigoori_avif"
+                    } else {
+                        "kakigoori_webp"
+                    },
+                    job_classes.clone(),
+                    file_processor(file_type),
+                    storage.clone(),
                 )));
             }
-            "webp" => {
+            // Queue for version 2 tasks asking for several file types at once
+            "all" => {
                 tasks.push(tokio::spawn(handle_file_type(
                     conn.create_channel().await?,
                     conn.create_channel().await?,
-                    "kakigoori_webp",
-                    file_processors::WebP {},
+                    "kakigoori_all",
+                    job_classes.clone(),
+                    None,
+                    storage.clone(),
                 )));
             }
             _ => {}
@@ -179,18 +470,18 @@ async fn main() -> io::Result<()> {
             for task in tasks {
                 let task_result = task.await?;
                 if let Err(e) = task_result {
-                    eprintln!("Error handling task: {}", e);
+                    eprintln!("Error handling task: {e}");
                 }
             }
 
             let conn_close_result = conn.close(REPLY_SUCCESS, ShortString::from("Normal shutdown")).await;
             if let Err(e) = conn_close_result {
-                eprintln!("Warning, error closing connection: {}", e);
+                eprintln!("Warning, error closing connection: {e}");
             }
         }
         Err(error) => {
             eprintln!("Failed to initialize the worker");
-            eprintln!("{}", error);
+            eprintln!("{error}");
             std::process::exit(1);
         }
     }
@@ -0,0 +1,96 @@
+use crate::json_messages::ObjectLocation;
+use s3::creds::Credentials;
+use s3::{Bucket, Region};
+use std::{fs, io};
+
+pub struct Storage {
+    bucket: Option<Box<Bucket>>,
+}
+
+impl Storage {
+    pub fn from_env() -> io::Result<Storage> {
+        let bucket_name = match std::env::var("S3_BUCKET") {
+            Ok(bucket_name) => bucket_name,
+            Err(_) => return Ok(Storage { bucket: None }),
+        };
+
+        let region = Region::Custom {
+            region: std::env::var("S3_REGION").unwrap_or_else(|_| "us-east-1".into()),
+            endpoint: std::env::var("S3_ENDPOINT").map_err(io::Error::other)?,
+        };
+
+        let credentials = Credentials::new(
+            std::env::var("S3_KEY_ID").ok().as_deref(),
+            std::env::var("S3_SECRET_KEY").ok().as_deref(),
+            None,
+            None,
+            None,
+        )
+        .map_err(io::Error::other)?;
+
+        let bucket = Bucket::new(&bucket_name, region, credentials)
+            .map_err(io::Error::other)?
+            .with_path_style();
+
+        Ok(Storage {
+            bucket: Some(bucket),
+        })
+    }
+
+    fn bucket(&self) -> io::Result<&Bucket> {
+        self.bucket
+            .as_deref()
+            .ok_or_else(|| io::Error::other("S3 storage is not configured"))
+    }
+
+    pub async fn read(&self, location: &ObjectLocation) -> io::Result<Vec<u8>> {
+        match location {
+            ObjectLocation::Path(path) => fs::read(path),
+            ObjectLocation::S3Key(key) => {
+                let response = self
+                    .bucket()?
+                    .get_object(key)
+                    .await
+                    .map_err(io::Error::other)?;
+
+                if response.status_code() != 200 {
+                    return Err(io::Error::other(format!(
+                        "failed to read {}, status {}",
+                        key,
+                        response.status_code()
+                    )));
+                }
+
+                Ok(response.bytes().to_vec())
+            }
+        }
+    }
+
+    pub async fn write(
+        &self,
+        location: &ObjectLocation,
+        contents: &[u8],
+        content_type: &str,
+    ) -> io::Result<()> {
+        match location {
+            ObjectLocation::Path(path) => fs::write(path, contents),
+            ObjectLocation::S3Key(key) => {
+                let response = self
+                    .bucket()?
+                    .put_object_with_content_type(key, contents, content_type)
+                    .await
+                    .map_err(io::Error::other)?;
+
+                if response.status_code() != 200 {
+                    return Err(io::Error::other(format!(
+                        "failed to write {}, status {}",
+                        key,
+                        response.status_code()
+                    )));
+                }
+
+                Ok(())
+            }
+        }
+    }
+}